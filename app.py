@@ -1,26 +1,111 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from config import Config
+from database import init_database, reporting_view
 from extentions import db, login_manager
 from models import (
     User, Route, RoutePoint, RouteAssignment,
     Store, EvaluationParameter, StoreEvaluation, StoreEvaluationDetail, QuotaCategory,
     CustomerReport, RouteReport, GradeMapping, CustomerEvaluation, DescriptiveCriterion,
-    CSVEvaluationRecord, Province, ProvinceTarget
+    CSVEvaluationRecord, Province, ProvinceTarget, VisitEvent, RouteProgress
 )
 from forms import (
     LoginForm, UserForm, RouteForm, RoutePointForm,
     StoreForm, EvaluationParameterForm, StoreEvaluationForm, QuotaCategoryForm,
-    GradeMappingForm, CustomerEvaluationForm, TargetSettingForm
+    GradeMappingForm, CustomerEvaluationForm, TargetSettingForm, TerritoryPartitionForm
 )
+from geo import SPATIAL_INDEXES, ensure_spatial_indexes, remove_province_from_spatial_index
+from heatmap import DEFAULT_RESOLUTION, HEATMAP_RESOLUTIONS, get_heatmap, mark_heatmap_province_changed
+from identity import identity_cache
+from locations import (
+    ingest_batch, location_buffer, location_publisher, parse_device_time, plausible_device_time, position_store
+)
+from map_clusters import CLUSTER_MAX_ZOOM, get_pyramid, mark_province_changed
+from metrics import csv_rows_imported, evaluation_rows_scored, location_pings, metrics_store
+from migrations import explain_hot_queries, pending_migrations, run_migrations
+from profiling import request_profiler
+from refdata import (
+    UNGRADED, criterion_score, get_descriptive_criteria, get_grade_mappings, get_grade_weights,
+    get_latest_province_targets, get_provinces, get_quota_categories, grade_for_score, reference_cache,
+    save_grade_weights
+)
+from search import ensure_search_index, remove_province_from_index, search_customers
+from visits import complete_finished_assignments, visit_detector
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_, desc, text
-from datetime import datetime, timezone
+from sqlalchemy.orm import selectinload
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import click
 import csv
+import hmac
 import io
-import pandas as pd
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import session
+
+# Rows fetched per round-trip when streaming large customer exports
+STREAM_BATCH_SIZE = 1000
+# Comment lines sent on idle event streams so proxies keep the connection open
+SSE_KEEPALIVE_SECONDS = 15
+# How long EventSource waits before reconnecting a stream that ended
+SSE_RETRY_MS = 2000
+# Run by benchmark-startup in a fresh interpreter; ru_maxrss is in KiB on Linux. The framework
+# packages are timed on their own first, so the app's share does not move with the machine.
+STARTUP_PROBE = """
+import json, resource, time
+started = time.perf_counter()
+import flask, flask_login, flask_sqlalchemy, flask_wtf, sqlalchemy.orm, werkzeug.security, wtforms
+framework = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print(json.dumps({'framework_s': framework - started, 'import_s': imported - framework,
+                  'create_app_s': time.perf_counter() - imported,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+# Seeded by seed_provinces(); populations from the 2016 census
+IRAN_PROVINCES = (
+    ("تهران", 13267637),
+    ("خراسان رضوی", 6434501),
+    ("اصفهان", 5120850),
+    ("فارس", 4851274),
+    ("خوزستان", 4710509),
+    ("آذربایجان شرقی", 3909652),
+    ("مازندران", 3283582),
+    ("آذربایجان غربی", 3265219),
+    ("کرمان", 3164718),
+    ("سیستان و بلوچستان", 2775014),
+    ("البرز", 2712400),
+    ("گیلان", 2530696),
+    ("کرمانشاه", 1952434),
+    ("لرستان", 1760649),
+    ("همدان", 1738234),
+    ("گلستان", 1777014),
+    ("کردستان", 1603011),
+    ("هرمزگان", 1578183),
+    ("مرکزی", 1429475),
+    ("اردبیل", 1270420),
+    ("قزوین", 1201565),
+    ("قم", 1151672),
+    ("یزد", 1074428),
+    ("زنجان", 1015734),
+    ("بوشهر", 1032949),
+    ("چهارمحال و بختیاری", 895263),
+    ("خراسان شمالی", 867727),
+    ("کهگیلویه و بویراحمد", 658629),
+    ("خراسان جنوبی", 622534),
+    ("سمنان", 631218),
+    ("ایلام", 557599),
+)
+
 def create_admin_user():
     """Ensure an admin user named 'admin' exists."""
     admin_user = User.query.filter_by(username='admin').first()
@@ -36,6 +121,25 @@ def create_admin_user():
         db.session.add(new_admin)
         db.session.commit()
 
+def seed_provinces():
+    """Add the provinces unless any exist; the caller commits. Returns how many were added."""
+    if Province.query.count():
+        return 0
+    db.session.add_all(Province(name=name, population=population) for name, population in IRAN_PROVINCES)
+    return len(IRAN_PROVINCES)
+
+def bootstrap_database():
+    """One-time setup: tables, migrations, search and spatial indexes, the admin user and provinces."""
+    # Only the default bind; the reader is a replica (or a second pool) of the same database
+    db.create_all(bind_key=None)
+    applied = run_migrations()
+    ensure_search_index()
+    ensure_spatial_indexes()
+    create_admin_user()
+    seeded = seed_provinces()
+    db.session.commit()
+    return applied, seeded
+
 def safe_float(val):
     """Convert a value to float safely; return None if conversion fails."""
     try:
@@ -43,21 +147,74 @@ def safe_float(val):
     except (TypeError, ValueError):
         return None
 
-def create_app():
+def populate_partition_choices(form, marketers):
+    """Offer provinces that have geocoded customers, and the given marketers."""
+    provinces = db.session.query(CustomerReport.province).filter(
+        CustomerReport.province.isnot(None), CustomerReport.latitude.isnot(None)
+    ).distinct().order_by(CustomerReport.province)
+    form.province.choices = [(p, p) for p, in provinces]
+    form.marketer_ids.choices = [(m.id, m.fullname or m.username) for m in marketers]
+
+@contextmanager
+def scratch_app(database_url=None):
+    """A separate, bootstrapped app on an empty scratch database, for the CLI checks.
+
+    State files live in a temporary directory, so nothing touches the
+    configured database or the shared files of running workers. The
+    scratch database is emptied again afterwards.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        scratch = create_app({
+            'SQLALCHEMY_DATABASE_URI': database_url or 'sqlite:///' + os.path.join(directory, 'check.db'),
+            'DATABASE_REPLICA_URI': None,
+            'POSITION_STORE_PATH': os.path.join(directory, 'positions.bin'),
+            'REFERENCE_VERSIONS_PATH': os.path.join(directory, 'reference_versions.bin'),
+            'METRICS_DIR': os.path.join(directory, 'metrics'),
+            'WTF_CSRF_ENABLED': False,
+            'PROFILING_ENABLED': False,
+        })
+        with scratch.app_context():
+            if db.inspect(db.engine).get_table_names():
+                raise SystemExit('The check database must be empty; the check fills it with fixture data.')
+            bootstrap_database()
+        try:
+            yield scratch
+        finally:
+            # Whatever the check left buffered goes to the scratch database now, not at exit after it is gone
+            location_buffer.flush()
+            position_store.checkpoint()
+            with scratch.app_context():
+                db.session.remove()
+                db.drop_all(bind_key=None)
+                for engine in db.engines.values():
+                    engine.dispose()
+
+def create_app(overrides=None):
     app = Flask(__name__)
     app.config.from_object(Config)
+    app.config.update(overrides or {})
 
-    db.init_app(app)
+    init_database(app)
     login_manager.init_app(app)
+    location_buffer.init_app(app)
+    position_store.init_app(app)
+    reference_cache.init_app(app)
+    identity_cache.init_app(app)
+    visit_detector.init_app(app)
+    request_profiler.init_app(app)
+    metrics_store.init_app(app)
 
     with app.app_context():
-        db.create_all()
-        create_admin_user()
+        # Schema and seed data are set up once by `flask bootstrap`, not by every worker
+        if pending_migrations():
+            app.logger.warning('The database is not initialized or not up to date; run "flask --app app bootstrap".')
+        else:
+            position_store.load_from_db()
 
     @login_manager.user_loader
     def load_user(user_id):
-        # Use Session.get() instead of Query.get()
-        return db.session.get(User, int(user_id))
+        # Cached, so location pings and polls authorize without reading the user table
+        return identity_cache.load(int(user_id))
 
     # --------------------- LOGIN / LOGOUT ---------------------
     @app.route('/login', methods=['GET', 'POST'])
@@ -148,7 +305,9 @@ def create_app():
         try:
             stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
             csv_reader = csv.DictReader(stream)
+            imported = 0
             for row in csv_reader:
+                imported += 1
                 report = RouteReport(
                     route_number=row.get('شماره_مسیر'),
                     route_name=row.get('نام_مسیر'),
@@ -159,6 +318,7 @@ def create_app():
                 )
                 db.session.add(report)
             db.session.commit()
+            csv_rows_imported.inc('routes', amount=imported)
             flash('فایل CSV اطلاعات مسیر با موفقیت بارگذاری و ذخیره شد.', 'success')
         except Exception as e:
             db.session.rollback()
@@ -186,8 +346,10 @@ def create_app():
         try:
             stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
             csv_reader = csv.DictReader(stream)
+            imported = 0
 
             for row in csv_reader:
+                imported += 1
                 report = CustomerReport(
                     textbox29=row.get('Textbox29'),
                     caption=row.get('Caption'),
@@ -206,6 +368,7 @@ def create_app():
                 db.session.add(report)
 
             db.session.commit()
+            csv_rows_imported.inc('customers', amount=imported)
             flash(f'فایل CSV اطلاعات مشتریان برای استان {province} با موفقیت بارگذاری و ذخیره شد.', 'success')
         except Exception as e:
             db.session.rollback()
@@ -255,6 +418,10 @@ def create_app():
             return jsonify({'error': 'Unauthorized'}), 403
 
         try:
+            remove_province_from_index(province)
+            remove_province_from_spatial_index(province)
+            mark_province_changed(province)
+            mark_heatmap_province_changed(province)
             CustomerReport.query.filter_by(province=province).delete()
             db.session.commit()
             flash(f'تمام رکوردهای استان {province} با موفقیت حذف شدند.', 'success')
@@ -264,30 +431,20 @@ def create_app():
 
         return redirect(url_for('admin_customers_csv'))
 
-    def upgrade_customer_report():
-        """Add province column to customer_report table"""
-        with app.app_context():
-            # Add the province column if it doesn't exist
-            inspector = db.inspect(db.engine)
-            columns = [col['name'] for col in inspector.get_columns('customer_report')]
-
-            if 'province' not in columns:
-                # Create the province column
-                db.engine.execute('ALTER TABLE customer_report ADD COLUMN province VARCHAR(100)')
-
-                # Set default province for existing records
-                db.engine.execute("UPDATE customer_report SET province = 'نامشخص' WHERE province IS NULL")
-
-                db.session.commit()
-
-    @app.route('/admin/customers-csv/province/<province>')
+    @app.route('/admin/customers/search')
     @login_required
-    def get_province_customers(province):
+    def search_customers_api():
         if current_user.role != 'admin':
             return jsonify({'error': 'Unauthorized'}), 403
 
-        customers = CustomerReport.query.filter_by(province=province).all()
+        query = request.args.get('q', '').strip()
+        province = request.args.get('province') or None
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+        customers, total = search_customers(query, province=province, page=page, per_page=per_page)
         customer_data = [{
+            'id': c.id,
             'Textbox29': c.textbox29,
             'Caption': c.caption,
             'bname': c.bname,
@@ -300,10 +457,82 @@ def create_app():
             'Textbox4': c.textbox4,
             'Textbox10': c.textbox10,
             'Province': c.province,
-            'تاریخ_ایجاد': c.created_at.strftime('%Y-%m-%d %H:%M:%S')
+            'Grade': c.grade
         } for c in customers]
 
-        return jsonify(customer_data)
+        return jsonify({
+            'data': customer_data,
+            'total': total,
+            'pages': (total + per_page - 1) // per_page,
+            'current_page': page
+        })
+
+    def iter_province_customers(province):
+        """Yield export dicts for a province straight from a column-projected cursor."""
+        # Only the exported columns are selected (no ORM entities / identity map),
+        # and yield_per hands rows over in chunks so memory stays flat.
+        query = db.session.query(
+            CustomerReport.textbox29,
+            CustomerReport.caption,
+            CustomerReport.bname,
+            CustomerReport.number,
+            CustomerReport.name,
+            CustomerReport.textbox16,
+            CustomerReport.textbox12,
+            CustomerReport.longitude,
+            CustomerReport.latitude,
+            CustomerReport.textbox4,
+            CustomerReport.textbox10,
+            CustomerReport.province,
+            CustomerReport.created_at
+        ).filter(CustomerReport.province == province) \
+            .order_by(CustomerReport.id) \
+            .execution_options(yield_per=STREAM_BATCH_SIZE)
+
+        for c in query:
+            yield {
+                'Textbox29': c.textbox29,
+                'Caption': c.caption,
+                'bname': c.bname,
+                'Number': c.number,
+                'Name': c.name,
+                'Textbox16': c.textbox16,
+                'Textbox12': c.textbox12,
+                'Longitude': c.longitude,
+                'Latitude': c.latitude,
+                'Textbox4': c.textbox4,
+                'Textbox10': c.textbox10,
+                'Province': c.province,
+                'تاریخ_ایجاد': c.created_at.strftime('%Y-%m-%d %H:%M:%S') if c.created_at else None
+            }
+
+    @app.route('/admin/customers-csv/province/<province>')
+    @login_required
+    def get_province_customers(province):
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        # Same JSON array as before, but written out chunk by chunk
+        def generate():
+            yield '['
+            for i, row in enumerate(iter_province_customers(province)):
+                yield (',' if i else '') + json.dumps(row, ensure_ascii=False)
+            yield ']'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    @app.route('/admin/customers-csv/province/<province>/ndjson')
+    @login_required
+    def stream_province_customers(province):
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        # One JSON object per line; the first record goes out as soon as it is read
+        def generate():
+            for row in iter_province_customers(province):
+                yield json.dumps(row, ensure_ascii=False) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 
@@ -327,116 +556,34 @@ def create_app():
 
     @app.route('/admin/customers-csv', methods=['GET'])
     @login_required
+    @reporting_view
     def admin_customers_csv():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
 
         try:
-            # Create provinces if they don't exist
-            if Province.query.count() == 0:
-                provinces_data = [
-                    ("تهران", 13267637),
-                    ("خراسان رضوی", 6434501),
-                    ("اصفهان", 5120850),
-                    ("فارس", 4851274),
-                    ("خوزستان", 4710509),
-                    ("آذربایجان شرقی", 3909652),
-                    ("مازندران", 3283582),
-                    ("آذربایجان غربی", 3265219),
-                    ("کرمان", 3164718),
-                    ("سیستان و بلوچستان", 2775014),
-                    ("البرز", 2712400),
-                    ("گیلان", 2530696),
-                    ("کرمانشاه", 1952434),
-                    ("لرستان", 1760649),
-                    ("همدان", 1738234),
-                    ("گلستان", 1777014),
-                    ("کردستان", 1603011),
-                    ("هرمزگان", 1578183),
-                    ("مرکزی", 1429475),
-                    ("اردبیل", 1270420),
-                    ("قزوین", 1201565),
-                    ("قم", 1151672),
-                    ("یزد", 1074428),
-                    ("زنجان", 1015734),
-                    ("بوشهر", 1032949),
-                    ("چهارمحال و بختیاری", 895263),
-                    ("خراسان شمالی", 867727),
-                    ("کهگیلویه و بویراحمد", 658629),
-                    ("خراسان جنوبی", 622534),
-                    ("سمنان", 631218),
-                    ("ایلام", 557599)
-                ]
-
-                for name, population in provinces_data:
-                    province = Province(name=name, population=population)
-                    db.session.add(province)
-
-                try:
-                    db.session.commit()
-                    print("Provinces initialized successfully")
-                except Exception as e:
-                    db.session.rollback()
-                    print(f"Error initializing provinces: {e}")
-                    flash('خطا در ایجاد استان‌ها', 'danger')
-
-            # Get all provinces for the dropdown
-            provinces = Province.query.order_by(Province.name).all()
-            print(f"Found {len(provinces)} provinces")
-            for p in provinces:
-                print(f"Province: {p.name}")
-
-            # Get all customer reports
-            all_customers = CustomerReport.query.all()
-            print(f"Found {len(all_customers)} customers")
+            # Read-only: provinces are seeded by bootstrap_database()
+            provinces = get_provinces()
+
+            # Plain rows instead of ORM instances; the page lists every customer
+            columns = (
+                ('Textbox29', CustomerReport.textbox29), ('Caption', CustomerReport.caption),
+                ('bname', CustomerReport.bname), ('Number', CustomerReport.number), ('Name', CustomerReport.name),
+                ('Textbox16', CustomerReport.textbox16), ('Textbox12', CustomerReport.textbox12),
+                ('Longitude', CustomerReport.longitude), ('Latitude', CustomerReport.latitude),
+                ('Textbox4', CustomerReport.textbox4), ('Textbox10', CustomerReport.textbox10),
+                ('Province', CustomerReport.province), ('تاریخ_ایجاد', CustomerReport.created_at),
+            )
+            rows = db.session.query(*(column for _, column in columns)).order_by(CustomerReport.id).all()
 
             # Group data by province
             customer_data_by_province = {}
-            column_headers = []
-
-            if all_customers:
-                # Get headers from first record
-                sample_data = {
-                    'Textbox29': all_customers[0].textbox29,
-                    'Caption': all_customers[0].caption,
-                    'bname': all_customers[0].bname,
-                    'Number': all_customers[0].number,
-                    'Name': all_customers[0].name,
-                    'Textbox16': all_customers[0].textbox16,
-                    'Textbox12': all_customers[0].textbox12,
-                    'Longitude': all_customers[0].longitude,
-                    'Latitude': all_customers[0].latitude,
-                    'Textbox4': all_customers[0].textbox4,
-                    'Textbox10': all_customers[0].textbox10,
-                    'Province': all_customers[0].province,
-                    'تاریخ_ایجاد': all_customers[0].created_at.strftime('%Y-%m-%d %H:%M:%S')
-                }
-                column_headers = list(sample_data.keys())
-
-                # Group by province
-                for customer in all_customers:
-                    province_name = customer.province or 'نامشخص'
-
-                    if province_name not in customer_data_by_province:
-                        customer_data_by_province[province_name] = []
-
-                    customer_data = {
-                        'Textbox29': customer.textbox29,
-                        'Caption': customer.caption,
-                        'bname': customer.bname,
-                        'Number': customer.number,
-                        'Name': customer.name,
-                        'Textbox16': customer.textbox16,
-                        'Textbox12': customer.textbox12,
-                        'Longitude': customer.longitude,
-                        'Latitude': customer.latitude,
-                        'Textbox4': customer.textbox4,
-                        'Textbox10': customer.textbox10,
-                        'Province': customer.province,
-                        'تاریخ_ایجاد': customer.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                    }
-                    customer_data_by_province[province_name].append(customer_data)
+            column_headers = [header for header, _ in columns] if rows else []
+            for row in rows:
+                customer_data = dict(zip(column_headers, row))
+                customer_data['تاریخ_ایجاد'] = row.created_at.strftime('%Y-%m-%d %H:%M:%S')
+                customer_data_by_province.setdefault(row.province or 'نامشخص', []).append(customer_data)
 
             return render_template(
                 'admin/customers_csv.html',
@@ -444,9 +591,9 @@ def create_app():
                 customer_data_by_province=customer_data_by_province,
                 column_headers=column_headers
             )
-        except Exception as e:
-            print(f"Error in admin_customers_csv: {str(e)}")
-            flash(f'خطا در بارگذاری صفحه: {str(e)}', 'danger')
+        except Exception:
+            app.logger.exception('Loading the customer CSV page failed')
+            flash('خطا در بارگذاری صفحه', 'danger')
             return redirect(url_for('dashboard'))
     @app.route('/admin/customers-csv/map')
     @login_required
@@ -454,26 +601,49 @@ def create_app():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
-        customer_reports = CustomerReport.query.all()
-        customer_data = [{
-            'Textbox29': c.textbox29,
-            'Caption': c.caption,
-            'bname': c.bname,
-            'Number': c.number,
-            'Name': c.name,
-            'Textbox16': c.textbox16,
-            'Textbox12': c.textbox12,
-            'Longitude': c.longitude,
-            'Latitude': c.latitude,
-            'Textbox4': c.textbox4,
-            'Textbox10': c.textbox10,
-            'تاریخ_ایجاد': c.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        } for c in customer_reports]
-        return render_template('admin/customers_map.html', customer_data=customer_data)
+        # Markers are loaded per viewport from api_customer_map_clusters
+        provinces = get_provinces()
+        return render_template('admin/customers_map.html', provinces=provinces)
+
+    @app.route('/api/customers/map/clusters')
+    @login_required
+    def api_customer_map_clusters():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        bounds = [request.args.get(key, type=float) for key in ('min_lat', 'min_lng', 'max_lat', 'max_lng')]
+        zoom = request.args.get('zoom', type=int)
+        if None in bounds or zoom is None:
+            return jsonify({'error': 'Invalid data'}), 400
+
+        pyramid = get_pyramid(request.args.get('province') or None)
+        if zoom > CLUSTER_MAX_ZOOM:
+            points = pyramid.points(*bounds)
+            # Names only for the handful of customers actually drawn
+            names = dict(db.session.query(CustomerReport.id, CustomerReport.name)
+                         .filter(CustomerReport.id.in_([p['id'] for p in points])))
+            for point in points:
+                point['name'] = names.get(point['id'])
+            return jsonify({'zoom': zoom, 'clusters': [], 'points': points})
+        return jsonify({'zoom': zoom, 'clusters': pyramid.clusters(zoom, *bounds), 'points': []})
+
+    @app.route('/api/customers/heatmap')
+    @login_required
+    def api_customer_heatmap():
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        resolution = request.args.get('resolution', DEFAULT_RESOLUTION, type=float)
+        if resolution not in HEATMAP_RESOLUTIONS:
+            return jsonify({'error': 'Invalid resolution', 'allowed': HEATMAP_RESOLUTIONS}), 400
+
+        grid = get_heatmap(request.args.get('province') or None, resolution)
+        return jsonify({'resolution': resolution, 'cells': grid.cells()})
 
     # --------------------- ADMIN: QUOTAS (Grade Mapping, Customer List & Evaluations) ---------------------
     @app.route('/admin/quotas', methods=['GET', 'POST'])
     @login_required
+    @reporting_view
     def admin_quotas():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
@@ -489,7 +659,7 @@ def create_app():
         customers = CustomerReport.query.order_by(CustomerReport.number).all()
         
         # Get grade mappings
-        grade_mappings = GradeMapping.query.order_by(GradeMapping.min_score.desc()).all()
+        grade_mappings = get_grade_mappings()
         
         # Get individual evaluations (manual evaluations, limited to 100)
         evaluations = CustomerEvaluation.query.filter(
@@ -584,16 +754,10 @@ def create_app():
         batch_evaluations = sorted(batch_evaluations, key=lambda x: x.get('evaluated_at', datetime.min), reverse=True)
         
         # Get provinces and targets for the target setting section
-        provinces = Province.query.order_by(Province.name).all()
-        
-        # Get province targets if they exist
-        province_targets = {}
-        targets = ProvinceTarget.query.order_by(ProvinceTarget.id.desc()).limit(31).all()
+        provinces = get_provinces()
         
-        # Create a mapping of province ID to target
-        for target in targets:
-            if target.province_id not in province_targets:
-                province_targets[target.province_id] = target
+        # Latest target of each province, if set
+        province_targets = get_latest_province_targets()
         
         # Process POST request for target setting
         if 'submit_target' in request.form:
@@ -680,45 +844,7 @@ def create_app():
             flash('استان‌ها قبلاً اضافه شده‌اند.', 'info')
             return redirect(url_for('admin_customers_csv'))
 
-        # Province data (name, population)
-        provinces_data = [
-            ("تهران", 13267637),
-            ("خراسان رضوی", 6434501),
-            ("اصفهان", 5120850),
-            ("فارس", 4851274),
-            ("خوزستان", 4710509),
-            ("آذربایجان شرقی", 3909652),
-            ("مازندران", 3283582),
-            ("آذربایجان غربی", 3265219),
-            ("کرمان", 3164718),
-            ("سیستان و بلوچستان", 2775014),
-            ("البرز", 2712400),
-            ("گیلان", 2530696),
-            ("کرمانشاه", 1952434),
-            ("لرستان", 1760649),
-            ("همدان", 1738234),
-            ("گلستان", 1777014),
-            ("کردستان", 1603011),
-            ("هرمزگان", 1578183),
-            ("مرکزی", 1429475),
-            ("اردبیل", 1270420),
-            ("قزوین", 1201565),
-            ("قم", 1151672),
-            ("یزد", 1074428),
-            ("زنجان", 1015734),
-            ("بوشهر", 1032949),
-            ("چهارمحال و بختیاری", 895263),
-            ("خراسان شمالی", 867727),
-            ("کهگیلویه و بویراحمد", 658629),
-            ("خراسان جنوبی", 622534),
-            ("سمنان", 631218),
-            ("ایلام", 557599)
-        ]
-
-        for name, population in provinces_data:
-            province = Province(name=name, population=population)
-            db.session.add(province)
-
+        seed_provinces()
         try:
             db.session.commit()
             flash('استان‌ها با موفقیت اضافه شدند.', 'success')
@@ -730,59 +856,48 @@ def create_app():
 
     @app.route('/admin/province_targets')
     @login_required
+    @reporting_view
     def admin_province_targets():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
 
         # Get provinces and targets
-        provinces = Province.query.order_by(Province.name).all()
+        provinces = get_provinces()
 
         # Get the latest target for each province
-        province_targets = {}
-        for province in provinces:
-            target = ProvinceTarget.query.filter_by(province_id=province.id).order_by(ProvinceTarget.id.desc()).first()
-            if target:
-                province_targets[province.id] = target
-
-        # Get customers by province
-        customers_by_province = {}
-        for province in provinces:
-            customers = CustomerReport.query.filter_by(province=province.name).all()
-            customers_by_province[province.id] = customers
+        province_targets = get_latest_province_targets()
 
         # Get all grade mappings for allocation by grade
-        grade_mappings = GradeMapping.query.order_by(GradeMapping.min_score.desc()).all()
+        grade_mappings = get_grade_mappings()
 
-        # Count customers by grade for each province
+        # Count customers by grade for each province, in one grouped query
+        counts = db.session.query(CustomerReport.province, CustomerReport.grade, db.func.count(CustomerReport.id)) \
+            .group_by(CustomerReport.province, CustomerReport.grade).all()
+        province_ids = {province.name: province.id for province in provinces}
+        customer_counts_by_province = {province.id: 0 for province in provinces}
         customer_grades_by_province = {}
-        for province_id, customers in customers_by_province.items():
+        for province in provinces:
             grade_counts = {}
             for grade_mapping in grade_mappings:
                 grade_counts[grade_mapping.grade_letter] = 0
 
             # Count ungraded customers too
-            grade_counts['بدون درجه'] = 0
-
-            for customer in customers:
-                if customer.grade in grade_counts:
-                    grade_counts[customer.grade] += 1
-                else:
-                    grade_counts['بدون درجه'] += 1
+            grade_counts[UNGRADED] = 0
+            customer_grades_by_province[province.id] = grade_counts
 
-            customer_grades_by_province[province_id] = grade_counts
-
-        # Get grade weights from session or set defaults
-        grade_weights = session.get('grade_weights', {})
+        for province_name, grade, count in counts:
+            province_id = province_ids.get(province_name)
+            if province_id is None:
+                continue
+            grade_counts = customer_grades_by_province[province_id]
+            grade_counts[grade if grade in grade_counts else UNGRADED] += count
+            customer_counts_by_province[province_id] += count
 
-        # If no weights in session, set defaults based on min_score
-        if not grade_weights:
-            for grade_mapping in grade_mappings:
-                # Set weights based on min_score (higher score = higher weight)
-                grade_weights[grade_mapping.grade_letter] = grade_mapping.min_score / 100
+        from territory import default_grade_weights
 
-            # Default weight for ungraded customers
-            grade_weights['بدون درجه'] = 0.5
+        # Saved grade weights, or defaults based on min_score
+        grade_weights = get_grade_weights() or default_grade_weights()
 
         # Check what capacities were set (for table headers)
         has_liter = any(t.liter_capacity is not None for t in province_targets.values()) if province_targets else False
@@ -843,7 +958,7 @@ def create_app():
                                province_targets=province_targets,
                                has_liter=has_liter,
                                has_shrink=has_shrink,
-                               customers_by_province=customers_by_province,
+                               customer_counts_by_province=customer_counts_by_province,
                                customer_grades_by_province=customer_grades_by_province,
                                grade_mappings=grade_mappings,
                                grade_weights=grade_weights,
@@ -865,8 +980,9 @@ def create_app():
                 except ValueError:
                     pass
 
-        # Store weights in session for persistence
-        session['grade_weights'] = weights
+        # Stored in the database so every worker and every admin sees the same weights
+        save_grade_weights(weights)
+        db.session.commit()
 
         flash('وزن‌های درجه‌بندی با موفقیت به‌روزرسانی شدند.', 'success')
         return redirect(url_for('admin_province_targets'))
@@ -900,12 +1016,7 @@ def create_app():
                     form.luxury_weight.data * form.luxury_score.data +
                     form.brand_weight.data * form.brand_score.data
                 )
-                mapping_obj = GradeMapping.query.filter(GradeMapping.min_score <= total_score)\
-                            .order_by(GradeMapping.min_score.desc()).first()
-                if mapping_obj:
-                    assigned_grade = mapping_obj.grade_letter
-                else:
-                    assigned_grade = "بدون درجه"
+                assigned_grade = grade_for_score(total_score)
                 flash(f'ارزیابی انجام شد. نمره کل: {total_score:.2f}, درجه: {assigned_grade}', 'success')
                 evaluation = CustomerEvaluation(
                     customer_id=customer.id,
@@ -1005,6 +1116,7 @@ def create_app():
                 user_to_edit.role = form.role.data
                 try:
                     db.session.commit()
+                    position_store.roster_changed()
                     flash('کاربر با موفقیت ویرایش شد.', 'success')
                     return redirect(url_for('admin_users'))
                 except IntegrityError:
@@ -1022,6 +1134,7 @@ def create_app():
                 try:
                     db.session.add(new_user)
                     db.session.commit()
+                    position_store.roster_changed()
                     flash('کاربر جدید ساخته شد.', 'success')
                     return redirect(url_for('admin_users'))
                 except IntegrityError:
@@ -1048,6 +1161,8 @@ def create_app():
             return redirect(url_for('admin_users'))
         db.session.delete(user_to_delete)
         db.session.commit()
+        position_store.clear(user_id)
+        position_store.roster_changed()
         flash('کاربر حذف شد.', 'info')
         return redirect(url_for('admin_users'))
 
@@ -1078,8 +1193,57 @@ def create_app():
             except IntegrityError:
                 db.session.rollback()
                 flash('خطا در ایجاد مسیر.', 'danger')
-        routes = Route.query.all()
-        return render_template('admin/routes.html', route_form=route_form, routes=routes)
+        # Counts come from correlated subqueries and marketers from one selectin query, so the
+        # page costs the same few queries however many routes it lists
+        point_count = db.select(db.func.count(RoutePoint.id)).where(RoutePoint.route_id == Route.id) \
+            .scalar_subquery()
+        completed_count = db.select(db.func.count(RouteAssignment.id)).where(
+            RouteAssignment.route_id == Route.id, RouteAssignment.completed.is_(True)
+        ).scalar_subquery()
+        page = request.args.get('page', 1, type=int)
+        routes = db.session.query(Route, point_count.label('point_count'), completed_count.label('completed_count')) \
+            .options(selectinload(Route.assignments).joinedload(RouteAssignment.marketer)) \
+            .order_by(Route.id.desc()) \
+            .paginate(page=page, per_page=app.config['ROUTES_PER_PAGE'], error_out=False)
+        partition_form = TerritoryPartitionForm()
+        populate_partition_choices(partition_form, marketers)
+        return render_template('admin/routes.html', route_form=route_form, partition_form=partition_form,
+                               routes=routes)
+
+    @app.route('/admin/routes/partition', methods=['POST'])
+    @login_required
+    def partition_territories():
+        if current_user.role != 'admin':
+            flash('دسترسی غیرمجاز!', 'danger')
+            return redirect(url_for('dashboard'))
+        form = TerritoryPartitionForm()
+        populate_partition_choices(form, User.query.filter_by(role='marketer').all())
+        if not form.validate_on_submit():
+            flash('اطلاعات تقسیم‌بندی نامعتبر است.', 'danger')
+            return redirect(url_for('admin_routes'))
+        if len(form.marketer_ids.data) > form.route_count.data:
+            flash('تعداد بازاریاب‌های انتخاب‌شده بیشتر از تعداد مسیرهاست.', 'danger')
+            return redirect(url_for('admin_routes'))
+
+        # Grade weights double as visit frequency, so routes carry equal workloads
+        from territory import create_territory_routes, default_grade_weights
+
+        grade_weights = get_grade_weights() or default_grade_weights()
+        routes, stats = create_territory_routes(form.province.data, form.route_count.data, grade_weights,
+                                                marketer_ids=form.marketer_ids.data)
+        if not routes:
+            flash('برای این استان مشتری دارای مختصات یافت نشد.', 'danger')
+            return redirect(url_for('admin_routes'))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash('خطا در ایجاد مسیرها.', 'danger')
+            return redirect(url_for('admin_routes'))
+        flash(f"{stats['customers']} مشتری در {stats['groups']} مسیر تقسیم شد "
+              f"(بار مسیرها بین {stats['min_load_ratio']:.0%} تا {stats['max_load_ratio']:.0%} میانگین، "
+              f"{stats['seconds']} ثانیه).", 'success')
+        return redirect(url_for('admin_routes'))
 
     @app.route('/admin/routes/<int:route_id>', methods=['GET', 'POST'])
     @login_required
@@ -1087,7 +1251,9 @@ def create_app():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
-        route = Route.query.get_or_404(route_id)
+        route = Route.query.options(
+            selectinload(Route.points), selectinload(Route.assignments).joinedload(RouteAssignment.marketer)
+        ).get_or_404(route_id)
         point_form = RoutePointForm()
         if point_form.validate_on_submit():
             new_point = RoutePoint(
@@ -1100,6 +1266,8 @@ def create_app():
             )
             db.session.add(new_point)
             try:
+                db.session.flush()
+                complete_finished_assignments(route.id, datetime.now(timezone.utc))
                 db.session.commit()
                 flash('نقطه جدید اضافه شد.', 'success')
             except IntegrityError:
@@ -1108,6 +1276,30 @@ def create_app():
             return redirect(url_for('admin_route_detail', route_id=route.id))
         return render_template('admin/route_detail.html', route=route, point_form=point_form)
 
+    @app.route('/admin/routes/<int:route_id>/optimize', methods=['POST'])
+    @login_required
+    def optimize_route_points(route_id):
+        if current_user.role != 'admin':
+            flash('دسترسی غیرمجاز!', 'danger')
+            return redirect(url_for('dashboard'))
+        from routing import optimize_route
+
+        route = Route.query.get_or_404(route_id)
+        try:
+            stats = optimize_route(route.id, time_budget=app.config['ROUTE_OPTIMIZE_SECONDS'])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            flash(f'خطا در بهینه‌سازی مسیر: {str(e)}', 'danger')
+            return redirect(url_for('admin_route_detail', route_id=route.id))
+        if not stats['reordered']:
+            flash(f"ترتیب فعلی نقاط ({stats['current_m'] / 1000:.1f} کیلومتر) کوتاه‌ترین مسیر یافت‌شده است و "
+                  f"تغییری نکرد.", 'info')
+            return redirect(url_for('admin_route_detail', route_id=route.id))
+        flash(f"ترتیب نقاط بهینه شد: طول مسیر از {stats['current_m'] / 1000:.1f} به "
+              f"{stats['optimized_m'] / 1000:.1f} کیلومتر رسید.", 'success')
+        return redirect(url_for('admin_route_detail', route_id=route.id))
+
     @app.route('/admin/routes/<int:route_id>/points/<int:point_id>', methods=['DELETE', 'POST'])
     @login_required
     def delete_route_point(route_id, point_id):
@@ -1116,7 +1308,15 @@ def create_app():
         point = RoutePoint.query.get_or_404(point_id)
         if point.route_id != route_id:
             return jsonify({'error': 'Not found'}), 404
+        # The point no longer counts towards the progress of assignments that visited it
+        visited_by = db.select(VisitEvent.assignment_id).where(VisitEvent.route_point_id == point.id)
+        RouteProgress.query.filter(RouteProgress.assignment_id.in_(visited_by)) \
+            .update({'points_visited': RouteProgress.points_visited - 1}, synchronize_session=False)
+        VisitEvent.query.filter_by(route_point_id=point.id).delete()
         db.session.delete(point)
+        db.session.flush()
+        # Deleting the last unvisited point finishes the route for whoever visited the rest
+        complete_finished_assignments(route_id, datetime.now(timezone.utc))
         db.session.commit()
         if request.method == 'DELETE':
             return jsonify({'message': 'Point deleted'})
@@ -1148,6 +1348,27 @@ def create_app():
             return redirect(url_for('dashboard'))
         return render_template('admin/settings.html')
 
+    @app.route('/admin/perf')
+    @login_required
+    def admin_perf():
+        if current_user.role != 'admin':
+            flash('دسترسی غیرمجاز!', 'danger')
+            return redirect(url_for('dashboard'))
+        return render_template('admin/perf.html', enabled=request_profiler.enabled,
+                               endpoints=request_profiler.summary() if request_profiler.enabled else [],
+                               slow_queries=list(reversed(request_profiler.slow_queries)),
+                               trace_memory=request_profiler.enabled and request_profiler.trace_memory,
+                               slow_query_ms=app.config['SLOW_QUERY_MS'], pid=os.getpid())
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        token = app.config['METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        scraper = token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+        if not scraper and not (current_user.is_authenticated and current_user.role == 'admin'):
+            return jsonify({'error': 'Unauthorized'}), 403
+        return Response(metrics_store.exposition(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/admin/marketer_locations')
     @login_required
     def admin_marketer_locations():
@@ -1156,6 +1377,23 @@ def create_app():
             return redirect(url_for('dashboard'))
         return render_template('admin/marketer_locations.html')
 
+    @app.route('/observer/gps')
+    @login_required
+    def observer_gps():
+        if current_user.role not in ['admin', 'observer']:
+            flash('دسترسی غیرمجاز!', 'danger')
+            return redirect(url_for('dashboard'))
+        marketers = User.query.filter_by(role='marketer').order_by(User.fullname).all()
+        return render_template('observer/gps.html', marketers=marketers)
+
+    @app.route('/observer/performance')
+    @login_required
+    def observer_performance():
+        if current_user.role not in ['admin', 'observer']:
+            flash('دسترسی غیرمجاز!', 'danger')
+            return redirect(url_for('dashboard'))
+        return render_template('observer/performance.html')
+
     # --------------------- ADMIN: DESCRIPTIVE CRITERIA MANAGEMENT ---------------------
     @app.route('/admin/descriptive_criteria', methods=['GET', 'POST'])
     @login_required
@@ -1163,7 +1401,7 @@ def create_app():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
-        criteria = DescriptiveCriterion.query.all()
+        criteria = get_descriptive_criteria()
         if request.method == 'POST':
             parameter = request.form.get('parameter')
             criterion = request.form.get('criterion')
@@ -1227,6 +1465,8 @@ def create_app():
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
+        # Imported here: pandas alone takes a third of a second to load, and only this view needs it
+        import pandas as pd
             
         if request.method == 'GET':
             return render_template('admin/evaluate_csv_upload.html')
@@ -1256,7 +1496,7 @@ def create_app():
                 file_content = df.to_csv(index=False)
                 
                 # Get all defined descriptive criteria for dropdown options
-                descriptive_criteria = DescriptiveCriterion.query.all()
+                descriptive_criteria = get_descriptive_criteria()
                 criteria_by_param = {}
                 for crit in descriptive_criteria:
                     if crit.parameter_name not in criteria_by_param:
@@ -1267,7 +1507,7 @@ def create_app():
                     })
 
                 # Get all grade mappings for debugging/display
-                grade_mappings = GradeMapping.query.order_by(GradeMapping.min_score.desc()).all()
+                grade_mappings = get_grade_mappings()
                     
                 return render_template('admin/evaluate_csv_configure.html', 
                                       columns=columns, 
@@ -1346,7 +1586,7 @@ def create_app():
                 grades = []
                 
                 # Get all grade mappings for scoring
-                all_grade_mappings = GradeMapping.query.order_by(GradeMapping.min_score.desc()).all()
+                all_grade_mappings = get_grade_mappings()
                 
                 # Create a batch identifier for this evaluation session
                 evaluation_batch_id = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
@@ -1401,12 +1641,9 @@ def create_app():
                                 # If no match was found in the form criteria, check database
                                 if not found_match:
                                     # Otherwise use existing criteria from database
-                                    crit = DescriptiveCriterion.query.filter(
-                                        DescriptiveCriterion.parameter_name.ilike(col),
-                                        DescriptiveCriterion.criterion.ilike(val_str)
-                                    ).first()
-                                    if crit:
-                                        param_score = params['weight'] * crit.score
+                                    crit_score = criterion_score(col, val_str)
+                                    if crit_score is not None:
+                                        param_score = params['weight'] * crit_score
                                     
                         # Add to total score and track individual parameter score
                         score += param_score
@@ -1417,13 +1654,7 @@ def create_app():
                     total_scores.append(score)
                     
                     # Find the appropriate grade based on the score
-                    mapping_obj = GradeMapping.query.filter(GradeMapping.min_score <= score)\
-                                .order_by(GradeMapping.min_score.desc()).first()
-                                
-                    if mapping_obj:
-                        assigned_grade = mapping_obj.grade_letter
-                    else:
-                        assigned_grade = "بدون درجه"
+                    assigned_grade = grade_for_score(score)
                         
                     grades.append(assigned_grade)
                     
@@ -1478,6 +1709,7 @@ def create_app():
                         db.session.add(csv_record)
                         db.session.commit()
                         successful_evaluations += 1
+                        evaluation_rows_scored.inc()
                         print(f"Saved evaluation record for row {index} with grade {assigned_grade}")
                     except Exception as e:
                         db.session.rollback()
@@ -1529,6 +1761,7 @@ def create_app():
     # --------------------- NEW ROUTES FOR BATCH EVALUATION MANAGEMENT ---------------------
     @app.route('/admin/batch_evaluations/<batch_id>')
     @login_required
+    @reporting_view
     def view_batch_evaluations(batch_id):
         if current_user.role != 'admin':
             flash('دسترسی غیرمجاز!', 'danger')
@@ -1676,13 +1909,7 @@ def create_app():
                 new_score = float(request.form.get('total_score'))
                 
                 # Get appropriate grade based on the score
-                mapping_obj = GradeMapping.query.filter(GradeMapping.min_score <= new_score)\
-                            .order_by(GradeMapping.min_score.desc()).first()
-                
-                if mapping_obj:
-                    new_grade = mapping_obj.grade_letter
-                else:
-                    new_grade = "بدون درجه"
+                new_grade = grade_for_score(new_score)
                 
                 # Update evaluation record
                 evaluation.total_score = new_score
@@ -1722,7 +1949,7 @@ def create_app():
         # Modify the template to handle both types
         return render_template('admin/edit_evaluation.html', 
                             evaluation=evaluation, 
-                            grade_mappings=GradeMapping.query.order_by(GradeMapping.min_score.desc()).all(),
+                            grade_mappings=get_grade_mappings(),
                             is_csv_record=is_csv_record)
 
     # --------------------- ADMIN: QUOTA CATEGORIES MANAGEMENT ---------------------
@@ -1733,7 +1960,7 @@ def create_app():
             flash('دسترسی غیرمجاز!', 'danger')
             return redirect(url_for('dashboard'))
         form = QuotaCategoryForm()
-        quota_list = QuotaCategory.query.all()
+        quota_list = get_quota_categories()
         
         if form.validate_on_submit():
             category = form.category.data.strip()
@@ -1775,19 +2002,220 @@ def create_app():
         if current_user.role not in ['admin', 'observer']:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        marketers = User.query.filter_by(role='marketer').all()
+        # Served from the shared position store; the ETag is its write counter
+        etag = f'{position_store.roster_version}.{position_store.version}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        since = request.args.get('since')
+        if since:
+            try:
+                since = parse_device_time(since)
+            except (TypeError, ValueError, OverflowError, OSError):
+                return jsonify({'error': 'Invalid cursor'}), 400
+            since -= timedelta(seconds=app.config['LOCATION_CURSOR_OVERLAP_SECONDS'])
+        result, last_modified = position_store.snapshot(position_store.roster(), since=since)
+
+        if (not request.if_none_match and last_modified and request.if_modified_since
+                and last_modified.replace(microsecond=0) <= request.if_modified_since):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        response = jsonify(result)
+        response.set_etag(etag)
+        # Browsers revalidate on every poll and get a body-less 304 while nothing moved
+        response.headers['Cache-Control'] = 'no-cache'
+        if last_modified:
+            response.last_modified = last_modified
+            # Pass back as ?since= to receive only marketers that moved after this response; Z rather
+            # than +00:00, which a client that does not encode it sends back as a space
+            response.headers['X-Location-Cursor'] = \
+                last_modified.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+        return response
+
+    # --------------------- SPATIAL QUERIES ---------------------
+    @app.route('/api/geo/<kind>/bbox')
+    @login_required
+    def api_geo_bbox(kind):
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+        index = SPATIAL_INDEXES.get(kind)
+        if index is None:
+            return jsonify({'error': 'Not found'}), 404
+
+        bounds = [request.args.get(key, type=float) for key in ('min_lat', 'min_lng', 'max_lat', 'max_lng')]
+        if None in bounds:
+            return jsonify({'error': 'Invalid data'}), 400
+        limit = min(request.args.get('limit', 5000, type=int), 50000)
+        return jsonify(index.within_bbox(*bounds, province=request.args.get('province'), limit=limit))
+
+    @app.route('/api/geo/<kind>/radius')
+    @login_required
+    def api_geo_radius(kind):
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+        index = SPATIAL_INDEXES.get(kind)
+        if index is None:
+            return jsonify({'error': 'Not found'}), 404
+
+        lat = request.args.get('lat', type=float)
+        lng = request.args.get('lng', type=float)
+        radius = request.args.get('radius', 2000, type=float)
+        if lat is None or lng is None or radius <= 0:
+            return jsonify({'error': 'Invalid data'}), 400
+        limit = min(request.args.get('limit', 5000, type=int), 50000)
+        return jsonify(index.within_radius(lat, lng, radius, province=request.args.get('province'), limit=limit))
+
+    @app.route('/api/geo/<kind>/nearest')
+    @login_required
+    def api_geo_nearest(kind):
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+        index = SPATIAL_INDEXES.get(kind)
+        if index is None:
+            return jsonify({'error': 'Not found'}), 404
+
+        lat = request.args.get('lat', type=float)
+        lng = request.args.get('lng', type=float)
+        k = min(max(request.args.get('k', 10, type=int), 1), 1000)
+        if lat is None or lng is None:
+            return jsonify({'error': 'Invalid data'}), 400
+        return jsonify(index.nearest(lat, lng, k, province=request.args.get('province')))
+
+    @app.route('/api/observer/marketer-locations/stream')
+    @login_required
+    def api_marketer_locations_stream():
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        max_streams = app.config['SSE_MAX_STREAMS']
+        if max_streams is not None and location_publisher.subscriber_count >= max_streams:
+            # Every stream holds a thread; the page falls back to polling and retries
+            return jsonify({'error': 'Too many streams'}), 503, {'Retry-After': '30'}
+
+        # Server-Sent Events: one snapshot, then only the marketers that moved.
+        # The stream needs no request context, so no database session stays open with it.
+        subscriber, snapshot = location_publisher.subscribe()
+        ends_at = time.monotonic() + app.config['SSE_MAX_SECONDS']
+
+        def generate():
+            yield f"retry: {SSE_RETRY_MS}\nevent: snapshot\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+            while True:
+                remaining = ends_at - time.monotonic()
+                if remaining <= 0:
+                    # Ending releases the thread; EventSource reconnects and gets a fresh snapshot
+                    break
+                try:
+                    changed = subscriber.get(timeout=min(SSE_KEEPALIVE_SECONDS, remaining))
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if changed is None:
+                    break
+                yield f"event: update\ndata: {json.dumps(changed, ensure_ascii=False)}\n\n"
+
+        response = Response(generate(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(lambda: location_publisher.unsubscribe(subscriber))
+        return response
+
+    @app.route('/api/observer/marketers/<int:marketer_id>/track')
+    @login_required
+    def api_marketer_track(marketer_id):
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+        try:
+            day = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date() \
+                if request.args.get('date') else datetime.now(timezone.utc).date()
+        except ValueError:
+            return jsonify({'error': 'Invalid data'}), 400
+        tolerance = request.args.get('tolerance', app.config['TRACK_SIMPLIFY_METERS'], type=float)
+        if tolerance is None or tolerance < 0:
+            return jsonify({'error': 'Invalid data'}), 400
+
+        from tracks import day_track
+
+        # Simplified on the way out; points are [lat, lng, "HH:MM:SS"] to keep a day's track small
+        points, raw_count = day_track(marketer_id, day, tolerance)
+        return jsonify({'marketer_id': marketer_id, 'date': day.isoformat(),
+                        'raw_points': raw_count, 'points': points})
+
+    @app.route('/api/observer/visits')
+    @login_required
+    def api_visits():
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+        try:
+            day = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date() \
+                if request.args.get('date') else datetime.now(timezone.utc).date()
+        except ValueError:
+            return jsonify({'error': 'Invalid data'}), 400
+        start = datetime(day.year, day.month, day.day)
+        query = db.session.query(VisitEvent, RoutePoint.name).join(
+            RoutePoint, RoutePoint.id == VisitEvent.route_point_id
+        ).filter(VisitEvent.entered_at >= start, VisitEvent.entered_at < start + timedelta(days=1))
+        if request.args.get('marketer_id', type=int):
+            query = query.filter(VisitEvent.marketer_id == request.args.get('marketer_id', type=int))
+        if request.args.get('route_id', type=int):
+            query = query.filter(VisitEvent.route_id == request.args.get('route_id', type=int))
+
+        return jsonify([{
+            'id': visit.id,
+            'marketer_id': visit.marketer_id,
+            'route_id': visit.route_id,
+            'route_point_id': visit.route_point_id,
+            'route_point_name': point_name,
+            'entered_at': visit.entered_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'exited_at': visit.exited_at.strftime('%Y-%m-%d %H:%M:%S') if visit.exited_at else None,
+            'dwell_seconds': visit.dwell_seconds
+        } for visit, point_name in query.order_by(VisitEvent.entered_at).limit(5000)])
+
+    @app.route('/api/observer/route-progress')
+    @login_required
+    def api_route_progress():
+        if current_user.role not in ['admin', 'observer']:
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        # Counters are maintained as pings arrive, so this is one join and no history scan
+        points_total = db.session.query(
+            RoutePoint.route_id, db.func.count(RoutePoint.id).label('total')
+        ).group_by(RoutePoint.route_id).subquery()
+        query = db.session.query(
+            RouteAssignment, Route.name, User.fullname, User.username, points_total.c.total, RouteProgress
+        ).join(Route, Route.id == RouteAssignment.route_id) \
+            .join(User, User.id == RouteAssignment.marketer_id) \
+            .outerjoin(points_total, points_total.c.route_id == RouteAssignment.route_id) \
+            .outerjoin(RouteProgress, RouteProgress.assignment_id == RouteAssignment.id) \
+            .filter(RouteAssignment.is_active.is_(True))
+        if request.args.get('marketer_id', type=int):
+            query = query.filter(RouteAssignment.marketer_id == request.args.get('marketer_id', type=int))
+        if request.args.get('route_id', type=int):
+            query = query.filter(RouteAssignment.route_id == request.args.get('route_id', type=int))
+
         result = []
-        
-        for marketer in marketers:
-            location_data = {
-                'id': marketer.id,
-                'name': marketer.fullname or marketer.username,
-                'lat': marketer.current_lat,
-                'lng': marketer.current_lng,
-                'last_update': marketer.last_location_update.strftime('%Y-%m-%d %H:%M:%S') if marketer.last_location_update else None
-            }
-            result.append(location_data)
-        
+        for assignment, route_name, fullname, username, total, progress in query.order_by(RouteAssignment.id):
+            total = total or 0
+            visited = progress.points_visited if progress else 0
+            result.append({
+                'assignment_id': assignment.id,
+                'route_id': assignment.route_id,
+                'route_name': route_name,
+                'marketer_id': assignment.marketer_id,
+                'marketer_name': fullname or username,
+                'points_total': total,
+                'points_visited': visited,
+                'percent_complete': round(min(visited / total, 1.0) * 100, 1) if total else 0.0,
+                'distance_km': round(progress.distance_m / 1000, 2) if progress else 0.0,
+                'time_on_route_minutes': round((progress.last_ping_at - progress.started_at).total_seconds() / 60)
+                if progress else 0,
+                'out_of_order_visits': progress.out_of_order_visits if progress else 0,
+                'started_at': progress.started_at.strftime('%Y-%m-%d %H:%M:%S') if progress else None,
+                'completed': bool(assignment.completed),
+                'completed_at': assignment.completed_at.strftime('%Y-%m-%d %H:%M:%S') if assignment.completed_at else None
+            })
         return jsonify(result)
 
     # Add API endpoint for marketer to update location
@@ -1802,17 +2230,240 @@ def create_app():
             return jsonify({'error': 'Invalid data'}), 400
         
         try:
-            current_user.current_lat = float(data['lat'])
-            current_user.current_lng = float(data['lng'])
-            current_user.last_location_update = datetime.now(timezone.utc)
+            lat = float(data['lat'])
+            lng = float(data['lng'])
+            accuracy = safe_float(data.get('accuracy'))
+            device_time = parse_device_time(data.get('timestamp'))
+        except (TypeError, ValueError, OverflowError, OSError):
+            return jsonify({'error': 'Invalid data'}), 400
+        now = datetime.now(timezone.utc)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return jsonify({'error': 'Invalid data'}), 400
+        if device_time is not None and not plausible_device_time(device_time, now):
+            return jsonify({'error': 'Invalid data'}), 400
+
+        # The live position goes to the shared store; history is written in batches
+        position_store.update(current_user.id, lat, lng, now)
+        location_buffer.push(current_user.id, lat, lng, accuracy=accuracy, device_time=device_time, server_time=now)
+        location_pings.inc('live')
+        return jsonify({'success': True, 'message': 'Location updated'})
+
+    @app.route('/api/marketer/locations/batch', methods=['POST'])
+    @login_required
+    def api_upload_locations_batch():
+        if current_user.role != 'marketer':
+            return jsonify({'error': 'Unauthorized'}), 403
+
+        # Devices send the JSON array gzip- or deflate-compressed; cap the inflated size
+        body = request.get_data()
+        encoding = request.headers.get('Content-Encoding', '').lower()
+        if encoding in ('gzip', 'deflate'):
+            inflater = zlib.decompressobj(wbits=31 if encoding == 'gzip' else 15)
+            try:
+                body = inflater.decompress(body, app.config['LOCATION_BATCH_MAX_BYTES'])
+            except zlib.error:
+                return jsonify({'error': 'Invalid data'}), 400
+            if inflater.unconsumed_tail:
+                return jsonify({'error': 'Payload too large'}), 413
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return jsonify({'error': 'Invalid data'}), 400
+        points = data.get('points') if isinstance(data, dict) else data
+        if not isinstance(points, list) or not all(isinstance(p, dict) for p in points):
+            return jsonify({'error': 'Invalid data'}), 400
+        if len(points) > app.config['LOCATION_BATCH_MAX_POINTS']:
+            return jsonify({'error': 'Payload too large'}), 413
+
+        try:
+            result, newest = ingest_batch(current_user.id, points,
+                                          deadband_m=app.config['LOCATION_DEADBAND_METERS'],
+                                          deadband_s=app.config['LOCATION_DEADBAND_SECONDS'])
             db.session.commit()
-            return jsonify({'success': True, 'message': 'Location updated'})
-        except Exception as e:
+        except Exception:
             db.session.rollback()
-            return jsonify({'error': str(e)}), 500
+            # Database errors can carry SQL and values; they go to the log, not to the device
+            app.logger.exception('Storing a location batch for marketer %s failed', current_user.id)
+            return jsonify({'error': 'Could not store the locations, please retry'}), 500
+        location_pings.inc('batch', amount=result['received'])
+        if newest:
+            # Never moves the marketer behind a fresher live position
+            position_store.update(current_user.id, newest['lat'], newest['lng'], newest['device_time'],
+                                  only_if_newer=True)
+        return jsonify({'success': True, **result})
+
+    # --------------------- CLI ---------------------
+    @app.cli.command('compress-tracks')
+    @click.option('--days', type=int, default=None, help='Only compress history older than this many days.')
+    @click.option('--tolerance', type=float, default=None, help='Douglas–Peucker tolerance in meters.')
+    def compress_tracks(days, tolerance):
+        """Thin out old location history with Douglas–Peucker simplification."""
+        from tracks import compress_history
+
+        days = app.config['LOCATION_COMPRESS_AFTER_DAYS'] if days is None else days
+        tolerance = app.config['TRACK_SIMPLIFY_METERS'] if tolerance is None else tolerance
+        before = datetime.now(timezone.utc) - timedelta(days=days)
+        examined, deleted = compress_history(before, tolerance)
+        click.echo(f'Examined {examined} pings, deleted {deleted}.')
+
+    @app.cli.command('benchmark-routing')
+    @click.option('--routes', type=int, default=5, help='Synthetic routes per size.')
+    @click.option('--seed', type=int, default=0)
+    def benchmark_routing_command(routes, seed):
+        """Report stop-sequencing quality and runtime on synthetic routes."""
+        from routing import benchmark as benchmark_routing
+
+        for row in benchmark_routing(routes_per_size=routes, time_budget=app.config['ROUTE_OPTIMIZE_SECONDS'],
+                                     seed=seed):
+            click.echo(', '.join(f'{key}={value}' for key, value in row.items()))
+
+    @app.cli.command('bootstrap')
+    def bootstrap_command():
+        """Create tables, apply migrations, build indexes and seed the admin user and provinces."""
+        applied, seeded = bootstrap_database()
+        click.echo(f"Applied migrations: {', '.join(map(str, applied)) or 'none'}; seeded {seeded} provinces.")
+
+    @app.cli.command('benchmark-startup')
+    @click.option('--runs', type=int, default=5)
+    @click.option('--max-app-seconds', type=float, default=0.25,
+                  help="Fail if the app's own share of a median boot (its imports and create_app) is longer.")
+    @click.option('--max-seconds', type=float, default=None, help='Also fail if a median boot is longer.')
+    def benchmark_startup(runs, max_app_seconds, max_seconds):
+        """Time importing the app and create_app() in fresh processes, and report their peak RSS."""
+        samples = []
+        # The first run only warms the page cache
+        for run in range(runs + 1):
+            output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=app.root_path, check=True,
+                                    capture_output=True, text=True).stdout
+            if run:
+                samples.append(json.loads(output.strip().splitlines()[-1]))
+                click.echo(', '.join(f'{key}={value:.3f}' for key, value in samples[-1].items()))
+        own = sorted(s['import_s'] + s['create_app_s'] for s in samples)[runs // 2]
+        boot = sorted(s['framework_s'] + s['import_s'] + s['create_app_s'] for s in samples)[runs // 2]
+        click.echo(f'median boot {boot:.3f}s, of which the app {own:.3f}s, '
+                   f'peak RSS {max(s["rss_mb"] for s in samples):.0f} MB')
+        if own > max_app_seconds:
+            raise SystemExit(f"The app's share of a median boot, {own:.3f}s, exceeds {max_app_seconds}s.")
+        if max_seconds is not None and boot > max_seconds:
+            raise SystemExit(f'Median boot time {boot:.3f}s exceeds {max_seconds}s.')
+
+    @app.cli.command('benchmark-export')
+    @click.option('--rows', type=int, default=200000, help='Customers in the exported province.')
+    @click.option('--max-growth-mb', type=float, default=50.0, help='Fail if a streamed export grows peak RSS more.')
+    @click.option('--database-url', default=None, help='An empty scratch database; a temporary SQLite file by default.')
+    def benchmark_export(rows, max_growth_mb, database_url):
+        """Peak RSS and time to first byte of a province export, as it was (list) and streamed."""
+        # Imported here so benchmark code (and the Unix-only resource module) stays out of the workers
+        from benchmarks import EXPORT_PATHS, EXPORT_PROBE, seed_export_fixture
+
+        province = IRAN_PROVINCES[0][0]
+        with scratch_app(database_url) as checked:
+            with checked.app_context():
+                seed_export_fixture(province, rows)
+            overrides = {key: checked.config[key] for key in (
+                'SQLALCHEMY_DATABASE_URI', 'DATABASE_REPLICA_URI', 'POSITION_STORE_PATH',
+                'REFERENCE_VERSIONS_PATH', 'METRICS_DIR', 'WTF_CSRF_ENABLED', 'PROFILING_ENABLED')}
+            results = {}
+            for variant in EXPORT_PATHS:
+                output = subprocess.run([sys.executable, '-c', EXPORT_PROBE, json.dumps(overrides), province, variant],
+                                        cwd=app.root_path, check=True, capture_output=True, text=True).stdout
+                results[variant] = json.loads(output.strip().splitlines()[-1])
+                click.echo(f'{variant}: ' + ', '.join(f'{key}={value:.3f}' if isinstance(value, float) else
+                                                      f'{key}={value}' for key, value in results[variant].items()))
+
+        failed = [variant for variant in ('array', 'ndjson') if results[variant]['status'] != 200
+                  or results[variant]['rss_growth_mb'] > max_growth_mb]
+        if failed:
+            raise SystemExit(f"Streamed exports ({', '.join(failed)}) failed or grew peak RSS by more than "
+                             f'{max_growth_mb} MB.')
+
+    @app.cli.command('benchmark-pings')
+    @click.option('--marketers', type=int, default=800)
+    @click.option('--threads', type=int, default=8, help='Concurrent request threads, as gunicorn would run.')
+    @click.option('--seconds', type=float, default=10.0)
+    @click.option('--min-rate', type=float, default=270.0,
+                  help='Fail below this many stored pings/s (800 marketers every 3 s is about 270).')
+    @click.option('--baseline', is_flag=True, help='Also time a user row UPDATE and commit per ping, as before.')
+    @click.option('--database-url', default=None, help='An empty scratch database; a temporary SQLite file by default.')
+    def benchmark_pings(marketers, threads, seconds, min_rate, baseline, database_url):
+        """Sustained live pings/s through the request handler and the write-behind buffer, in one process."""
+        from benchmarks import ping_throughput
+
+        results = {}
+        for variant in (('commit', 'buffered') if baseline else ('buffered',)):
+            with scratch_app(database_url) as checked:
+                results[variant] = ping_throughput(checked, variant, marketers, threads, seconds)
+            click.echo(f'{variant}: ' + ', '.join(f'{key}={value:.3f}' if isinstance(value, float) else
+                                                  f'{key}={value}' for key, value in results[variant].items()))
+
+        result = results['buffered']
+        if result['failed'] or result['stored'] != result['accepted'] or result['stored_per_s'] < min_rate:
+            raise SystemExit(f"Stored {result['stored']} of {result['accepted']} pings at "
+                             f"{result['stored_per_s']:.0f}/s; expected all of them at {min_rate:.0f}/s or more.")
+
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Apply pending schema migrations (bootstrap also runs them)."""
+        applied = run_migrations()
+        click.echo(f"Applied migrations: {', '.join(map(str, applied))}." if applied else 'Schema is up to date.')
+
+    @app.cli.command('check-query-plans')
+    @click.option('--verbose', is_flag=True, help='Print every plan, not only the failing ones.')
+    def check_query_plans(verbose):
+        """EXPLAIN the hot queries and fail if any of them scans a whole table."""
+        failed = 0
+        for name, uses_index, plan in explain_hot_queries():
+            failed += not uses_index
+            click.echo(f"{'ok  ' if uses_index else 'SCAN'} {name}")
+            if verbose or not uses_index:
+                for line in plan:
+                    click.echo(f'       {line}')
+        if failed:
+            raise SystemExit(f'{failed} hot queries do not use an index.')
+
+    @app.cli.command('check-query-counts')
+    @click.option('--small', type=int, default=5, help='Routes and customers per province in the first pass.')
+    @click.option('--large', type=int, default=60, help='Routes and customers per province in the second pass.')
+    @click.option('--database-url', default=None, help='An empty scratch database; a temporary SQLite file by default.')
+    def check_query_counts(small, large, database_url):
+        """Fail if list and report pages issue more queries with more data (N+1) or exceed their budget."""
+        # Imported here so fixture and check code stays out of the workers
+        from querycheck import page_query_counts
+
+        with scratch_app(database_url) as checked:
+            results = page_query_counts(checked, small, large)
+
+        failed = 0
+        for path, status, small_count, large_count, budget in results:
+            ok = status == 200 and large_count <= small_count and large_count <= budget
+            failed += not ok
+            click.echo(f"{'ok  ' if ok else 'FAIL'} {path}: {small_count} -> {large_count} queries, "
+                       f"budget {budget} (HTTP {status})")
+        if failed:
+            raise SystemExit(f'{failed} pages issue too many queries.')
+
+    @app.cli.command('check-search')
+    @click.option('--database-url', default=None, help='An empty scratch database; a temporary SQLite file by default.')
+    def check_search(database_url):
+        """Fail if customer search misses Persian/Arabic spelling variants on this database engine."""
+        from querycheck import search_results
+
+        with scratch_app(database_url) as checked:
+            results = search_results(checked)
+
+        failed = 0
+        for query, expected, found in results:
+            ok = found == expected
+            failed += not ok
+            click.echo(f"{'ok  ' if ok else 'FAIL'} {query!r}: expected {sorted(expected)}, found {sorted(found)}")
+        if failed:
+            raise SystemExit(f'{failed} searches returned the wrong customers.')
 
     return app
 
 if __name__ == '__main__':
    application = create_app()
+   with application.app_context():
+       bootstrap_database()
    application.run(debug=True, port=5000)
\ No newline at end of file
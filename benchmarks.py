@@ -0,0 +1,186 @@
+import resource
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from flask import jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import insert
+
+from extentions import db
+from locations import location_buffer
+from models import CustomerReport, LocationPing, User
+
+# Run by benchmark-export in a fresh interpreter per variant, so each peak RSS is its own
+EXPORT_PROBE = """
+import json, sys
+from benchmarks import measure_export
+print(json.dumps(measure_export(json.loads(sys.argv[1]), sys.argv[2], sys.argv[3])))
+"""
+
+# The province export as it was (every row as an ORM entity, then one jsonify) and as it is now
+EXPORT_PATHS = {
+    'list': '/benchmark/customers-csv/province/{province}',
+    'array': '/admin/customers-csv/province/{province}',
+    'ndjson': '/admin/customers-csv/province/{province}/ndjson',
+}
+# The live ping endpoint as it is now and as it was (an UPDATE of the user row and a commit per ping)
+PING_PATHS = {
+    'buffered': '/api/marketer/update-location',
+    'commit': '/benchmark/marketer/update-location',
+}
+EXPORT_BATCH_SIZE = 5000
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed_export_fixture(province, rows):
+    """Add ``rows`` customers with typical field lengths to one province."""
+    for start in range(0, rows, EXPORT_BATCH_SIZE):
+        db.session.execute(insert(CustomerReport), [{
+            'textbox29': f'خیابان آزادی، کوچه {i % 97}، پلاک {i}',
+            'caption': 'سوپرمارکت',
+            'bname': f'فروشگاه شماره {i}',
+            'number': f'0912{i:07d}',
+            'name': f'مشتری {i}',
+            'textbox16': 'منطقه ۲',
+            'textbox12': 'توزیع مویرگی',
+            'longitude': 51.3 + (i % 1000) * 0.0002,
+            'latitude': 35.6 + (i % 1000) * 0.0002,
+            'textbox4': 'نقدی',
+            'textbox10': 'فعال',
+            'province': province,
+            'created_at': datetime.now(timezone.utc),
+        } for i in range(start, min(start + EXPORT_BATCH_SIZE, rows))])
+    db.session.commit()
+
+
+def _export_as_list(province):
+    customers = CustomerReport.query.filter_by(province=province).all()
+    return jsonify([{
+        'Textbox29': c.textbox29,
+        'Caption': c.caption,
+        'bname': c.bname,
+        'Number': c.number,
+        'Name': c.name,
+        'Textbox16': c.textbox16,
+        'Textbox12': c.textbox12,
+        'Longitude': c.longitude,
+        'Latitude': c.latitude,
+        'Textbox4': c.textbox4,
+        'Textbox10': c.textbox10,
+        'Province': c.province,
+        'تاریخ_ایجاد': c.created_at.strftime('%Y-%m-%d %H:%M:%S')
+    } for c in customers])
+
+
+def measure_export(overrides, province, variant, username='admin', password='adminpassword'):
+    """Download one province's export in this process.
+
+    Returns the growth of peak RSS over the request in MB, the time to the
+    first and the last byte in seconds and the response size in bytes.
+    """
+    from app import create_app
+
+    app = create_app(overrides)
+    app.add_url_rule(EXPORT_PATHS['list'].replace('{province}', '<province>'), 'benchmark_export_list',
+                     _export_as_list)
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': password})
+
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+    first_byte = None
+    size = 0
+    response = client.get(EXPORT_PATHS[variant].format(province=quote(province)), buffered=False)
+    for chunk in response.iter_encoded():
+        if first_byte is None and chunk:
+            first_byte = time.perf_counter() - started
+        size += len(chunk)
+    response.close()
+    return {
+        'status': response.status_code,
+        'rss_growth_mb': _peak_rss_mb() - baseline,
+        'first_byte_s': first_byte,
+        'total_s': time.perf_counter() - started,
+        'bytes': size,
+    }
+
+
+@login_required
+def _update_location_with_commit():
+    data = request.json
+    db.session.query(User).filter_by(id=current_user.id).update({
+        'current_lat': float(data['lat']),
+        'current_lng': float(data['lng']),
+        'last_location_update': datetime.now(timezone.utc),
+    })
+    db.session.commit()
+    return jsonify({'success': True, 'message': 'Location updated'})
+
+
+def ping_throughput(app, variant, marketers, threads, seconds):
+    """Post live pings from ``marketers`` logged-in marketers on ``threads`` threads for ``seconds``.
+
+    Each marketer moves about 110 m per ping, so the dead-band keeps every
+    one. Afterwards the buffer is flushed, and the pings that reached the
+    history table count as stored.
+    """
+    if variant == 'commit':
+        app.add_url_rule(PING_PATHS['commit'], 'benchmark_update_location', _update_location_with_commit,
+                         methods=['POST'])
+    with app.app_context():
+        users = [User(username=f'benchmark-{i}', password='-', role='marketer', fullname=f'Marketer {i}')
+                 for i in range(marketers)]
+        db.session.add_all(users)
+        db.session.commit()
+        marketer_ids = [user.id for user in users]
+
+    clients = []
+    for marketer_id in marketer_ids:
+        client = app.test_client()
+        # Logged in through the session directly; a password check per marketer would dominate setup
+        with client.session_transaction() as session:
+            session['_user_id'] = str(marketer_id)
+            session['_fresh'] = True
+        clients.append(client)
+
+    counts = [[0, 0] for _ in range(threads)]
+    deadline = time.perf_counter() + seconds
+
+    def post(n):
+        mine = clients[n::threads]
+        step = 0
+        while time.perf_counter() < deadline:
+            step += 1
+            for i, client in enumerate(mine):
+                status = client.post(PING_PATHS[variant], json={
+                    'lat': 35.0 + (step % 1000) * 0.001, 'lng': 51.0 + i * 0.01, 'accuracy': 10,
+                }).status_code
+                counts[n][status != 200] += 1
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=post, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    location_buffer.flush()
+    drained = time.perf_counter() - started
+
+    with app.app_context():
+        stored = LocationPing.query.count() if variant == 'buffered' else sum(n for n, _ in counts)
+    accepted = sum(n for n, _ in counts)
+    return {
+        'accepted': accepted,
+        'failed': sum(n for _, n in counts),
+        'accepted_per_s': accepted / elapsed,
+        'stored': stored,
+        'stored_per_s': stored / drained,
+        'drain_s': drained - elapsed,
+    }
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from extentions import db
+
+
+def is_sqlite(app):
+    return make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'sqlite'
+
+
+def _reader_uri(app):
+    """URI of the read-only ``reader`` bind, or None to read from the primary."""
+    if not is_sqlite(app):
+        return app.config.get('DATABASE_REPLICA_URI')
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.database in (None, '', ':memory:') or url.query.get('uri'):
+        return None
+    # A second pool over the same file; in WAL mode its readers never wait for the writer
+    return url.set(database=f'file:{url.database}', query={'mode': 'ro', 'uri': 'true'}) \
+        .render_as_string(hide_password=False)
+
+
+def init_database(app):
+    """Initialize ``db`` for the configured engine.
+
+    SQLite connections get WAL journaling, ``synchronous=NORMAL``, a busy
+    timeout and a larger page cache and memory map as they are opened, so
+    readers no longer block behind the location writer and concurrent
+    writers wait instead of failing with "database is locked". Server
+    databases (PostgreSQL) get a sized connection pool that checks
+    connections before use and recycles them before the server or a proxy
+    drops them.
+
+    Views marked with ``reporting_view`` read through a separate ``reader``
+    bind: a read-only pool over the SQLite file, or ``DATABASE_REPLICA_URI``
+    on PostgreSQL when one is configured.
+    """
+    sqlite = is_sqlite(app)
+    options = {}
+    if not sqlite:
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('pool_size', app.config.get('DATABASE_POOL_SIZE', 10))
+        options.setdefault('max_overflow', app.config.get('DATABASE_MAX_OVERFLOW', 20))
+        options.setdefault('pool_recycle', app.config.get('DATABASE_POOL_RECYCLE', 1800))
+        options.setdefault('pool_pre_ping', True)
+    reader = _reader_uri(app)
+    if reader:
+        # SQLALCHEMY_ENGINE_OPTIONS only reaches the default engine; binds take theirs with the URL
+        app.config['SQLALCHEMY_BINDS'] = {**(app.config.get('SQLALCHEMY_BINDS') or {}),
+                                          'reader': {'url': reader, **options}}
+    db.init_app(app)
+    if not sqlite:
+        return
+
+    shared = (
+        f"PRAGMA busy_timeout={int(app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+        # A negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size=-{int(app.config.get('SQLITE_CACHE_SIZE_KB', 65536))}",
+        f"PRAGMA mmap_size={int(app.config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+    )
+    primary = ('PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL') + shared
+
+    def on_connect(pragmas):
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+        return apply_pragmas
+
+    with app.app_context():
+        event.listen(db.engine, 'connect', on_connect(primary))
+        if reader:
+            event.listen(db.engines['reader'], 'connect', on_connect(shared + ('PRAGMA query_only=ON',)))
+
+
+def reporting_view(view):
+    """Run a view's GET requests against the ``reader`` bind.
+
+    Long report queries then never wait for, or hold up, the location and
+    import writers. Writes (ORM flushes, UPDATE/INSERT statements) still go
+    to the primary, and other methods are left alone so a POST reads its
+    own writes.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+        with reading_from_replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def reading_from_replica():
+    previous = g.get('use_reader', False)
+    g.use_reader = True
+    try:
+        yield
+    finally:
+        g.use_reader = previous
@@ -1,6 +1,28 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_login import LoginManager
+from sqlalchemy.sql.elements import TextClause
 
-db = SQLAlchemy()
+
+class RoutingSession(Session):
+    """Sends reads to the ``reader`` bind while ``g.use_reader`` is set; flushes always use the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_app_context() and g.get('use_reader')
+                and _is_read(clause)):
+            reader = self._db.engines.get('reader')
+            if reader is not None:
+                return reader
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _is_read(clause):
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().upper().startswith('SELECT')
+    return getattr(clause, 'is_select', False)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 login_manager.login_view = 'login'  # اگر کاربر لاگین نباشد، به این روت هدایت می‌شود
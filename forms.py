@@ -34,6 +34,12 @@ class RouteForm(FlaskForm):
     marketer_ids = SelectMultipleField('بازاریاب‌ها', coerce=int)
     submit = SubmitField('ذخیره مسیر')
 
+class TerritoryPartitionForm(FlaskForm):
+    province = SelectField('استان', validators=[DataRequired()])
+    route_count = IntegerField('تعداد مسیر', validators=[DataRequired(), NumberRange(min=1, max=500)])
+    marketer_ids = SelectMultipleField('بازاریاب‌ها (اختیاری، به ترتیب به مسیرها تخصیص می‌یابند)', coerce=int)
+    submit = SubmitField('تقسیم‌بندی خودکار')
+
 class RoutePointForm(FlaskForm):
     name = StringField('نام نقطه', validators=[DataRequired()])
     latitude = FloatField('عرض جغرافیایی', validators=[
@@ -0,0 +1,271 @@
+import math
+
+from sqlalchemy import event, text
+
+from extentions import db
+from models import CustomerReport, Store
+
+# NumPy is imported by the functions that use it, so workers boot without it (see benchmark-startup)
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE_LAT = 111320.0
+
+REBUILD_BATCH_SIZE = 5000
+# k-nearest searches start with this radius and double until enough points are found
+NEAREST_START_RADIUS_M = 500.0
+NEAREST_MAX_RADIUS_M = 2000000.0
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meters; works on scalars and NumPy arrays alike."""
+    import numpy as np
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def project_m(lat, lng):
+    """Equirectangular ``(x, y)`` in meters around the points' mean latitude.
+
+    Accurate to well under a percent across a province, which is plenty for
+    clustering and simplification.
+    """
+    import numpy as np
+    y = np.radians(lat) * EARTH_RADIUS_M
+    x = np.radians(lng) * EARTH_RADIUS_M * math.cos(math.radians(float(np.mean(lat))))
+    return x, y
+
+
+def deadband_mask(lat, lng, ts, meters, seconds, anchor=None):
+    """Mask of the pings worth storing from one marketer's time-ordered pings.
+
+    A ping is dropped when it lies within ``meters`` of the last kept ping and
+    less than ``seconds`` after it, so a marketer standing still leaves one
+    point per ``seconds`` instead of one per report. ``anchor`` is the last
+    kept ``(lat, lng, ts)`` before these pings, if any.
+    """
+    import numpy as np
+    n = len(ts)
+    keep = np.zeros(n, dtype=bool)
+    if not n:
+        return keep
+    start = 0
+    if anchor is None:
+        keep[0] = True
+        anchor = (lat[0], lng[0], ts[0])
+        start = 1
+    while start < n:
+        # Pings past the time window are kept anyway, so distances are only needed inside it
+        end = max(int(np.searchsorted(ts, anchor[2] + seconds, side='left')), start)
+        moved = np.flatnonzero(haversine_m(anchor[0], anchor[1], lat[start:end], lng[start:end]) >= meters)
+        nxt = start + int(moved[0]) if len(moved) else end
+        if nxt >= n:
+            break
+        keep[nxt] = True
+        anchor = (lat[nxt], lng[nxt], ts[nxt])
+        start = nxt + 1
+    return keep
+
+
+def simplify_mask(lat, lng, tolerance_m):
+    """Douglas–Peucker: mask of the points that keep a track within ``tolerance_m`` of the original."""
+    import numpy as np
+    n = len(lat)
+    keep = np.zeros(n, dtype=bool)
+    if not n:
+        return keep
+    keep[0] = keep[-1] = True
+    # An equirectangular projection around the track is accurate to well under the tolerance
+    x, y = project_m(lat, lng)
+
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length2 = dx * dx + dy * dy
+        # Distance to the segment, not the infinite line, so out-and-back trips survive
+        t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0) if length2 else 0.0
+        distances = np.hypot(px - t * dx, py - t * dy)
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance_m:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def radius_bbox(lat, lng, radius_m):
+    """Bounding box (min_lat, min_lng, max_lat, max_lng) enclosing a circle."""
+    dlat = radius_m / METERS_PER_DEGREE_LAT
+    dlng = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
+
+
+class SpatialIndex:
+    """An SQLite R*Tree over the coordinate columns of one model, kept in sync by mapper events.
+
+    Other databases use a B-tree on ``(lat, lng)`` (migration 4), which only
+    narrows a box to its latitude band; wide boxes over large tables are
+    slower there, so callers should pass a ``limit``.
+    """
+
+    def __init__(self, model, table, lat_column, lng_column):
+        self.model = model
+        self.table = table
+        self.lat_column = lat_column
+        self.lng_column = lng_column
+        self._insert_sql = text(
+            f"INSERT OR REPLACE INTO {table} (id, min_lat, max_lat, min_lng, max_lng) "
+            "VALUES (:id, :lat, :lat, :lng, :lng)"
+        )
+        self._delete_sql = text(f"DELETE FROM {table} WHERE id = :id")
+
+        event.listen(model, 'after_insert', self._after_insert)
+        event.listen(model, 'after_update', self._after_update)
+        event.listen(model, 'after_delete', self._after_delete)
+
+    # --------------------- Maintenance ---------------------
+    def ensure(self):
+        db.session.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+            "USING rtree(id, min_lat, max_lat, min_lng, max_lng)"
+        ))
+        indexed = db.session.execute(text(f"SELECT COUNT(*) FROM {self.table}")).scalar()
+        if not indexed and db.session.query(self.model.id).filter(
+                self.lat_column.isnot(None), self.lng_column.isnot(None)).first():
+            self.rebuild()
+
+    def rebuild(self):
+        db.session.execute(text(f"DELETE FROM {self.table}"))
+        query = db.session.query(self.model.id, self.lat_column, self.lng_column).filter(
+            self.lat_column.isnot(None), self.lng_column.isnot(None)
+        ).execution_options(yield_per=REBUILD_BATCH_SIZE)
+        batch = []
+        for row_id, lat, lng in query:
+            batch.append({'id': row_id, 'lat': lat, 'lng': lng})
+            if len(batch) >= REBUILD_BATCH_SIZE:
+                db.session.execute(self._insert_sql, batch)
+                batch = []
+        if batch:
+            db.session.execute(self._insert_sql, batch)
+
+    def _coords(self, target):
+        return getattr(target, self.lat_column.key), getattr(target, self.lng_column.key)
+
+    def _after_insert(self, mapper, connection, target):
+        lat, lng = self._coords(target)
+        if _is_supported(connection) and lat is not None and lng is not None:
+            connection.execute(self._insert_sql, {'id': target.id, 'lat': lat, 'lng': lng})
+
+    def _after_update(self, mapper, connection, target):
+        if not _is_supported(connection):
+            return
+        state = db.inspect(target)
+        if not (state.attrs[self.lat_column.key].history.has_changes()
+                or state.attrs[self.lng_column.key].history.has_changes()):
+            return
+        lat, lng = self._coords(target)
+        if lat is None or lng is None:
+            connection.execute(self._delete_sql, {'id': target.id})
+        else:
+            connection.execute(self._insert_sql, {'id': target.id, 'lat': lat, 'lng': lng})
+
+    def _after_delete(self, mapper, connection, target):
+        if _is_supported(connection):
+            connection.execute(self._delete_sql, {'id': target.id})
+
+    # --------------------- Queries ---------------------
+    def _candidates(self, min_lat, min_lng, max_lat, max_lng, province=None, limit=None):
+        """Rows whose exact coordinates fall inside the box, as (id, name, lat, lng, province).
+
+        With ``limit``, any ``limit`` of them; the database stops reading there.
+        """
+        model = self.model
+        if not _is_supported(db.session.connection()):
+            query = db.session.query(model.id, model.name, self.lat_column, self.lng_column, model.province) \
+                .filter(self.lat_column.between(min_lat, max_lat), self.lng_column.between(min_lng, max_lng))
+            if province:
+                query = query.filter(model.province == province)
+            return query.limit(limit).all() if limit else query.all()
+        # The R*Tree stores 32-bit floats rounded outwards, so the exact columns are re-checked
+        sql = (
+            f"SELECT m.id, m.name, m.{self.lat_column.key}, m.{self.lng_column.key}, m.province "
+            f"FROM {self.table} g JOIN {model.__tablename__} m ON m.id = g.id "
+            "WHERE g.min_lat <= :max_lat AND g.max_lat >= :min_lat "
+            "AND g.min_lng <= :max_lng AND g.max_lng >= :min_lng "
+            f"AND m.{self.lat_column.key} BETWEEN :min_lat AND :max_lat "
+            f"AND m.{self.lng_column.key} BETWEEN :min_lng AND :max_lng"
+        )
+        params = {'min_lat': min_lat, 'min_lng': min_lng, 'max_lat': max_lat, 'max_lng': max_lng}
+        if province:
+            sql += " AND m.province = :province"
+            params['province'] = province
+        if limit:
+            sql += " LIMIT :limit"
+            params['limit'] = limit
+        return db.session.execute(text(sql), params).fetchall()
+
+    def within_bbox(self, min_lat, min_lng, max_lat, max_lng, province=None, limit=None):
+        return [_as_dict(row) for row in self._candidates(min_lat, min_lng, max_lat, max_lng, province, limit)]
+
+    def within_radius(self, lat, lng, radius_m, province=None, limit=None):
+        import numpy as np
+        rows = self._candidates(*radius_bbox(lat, lng, radius_m), province=province)
+        if not rows:
+            return []
+        distances = haversine_m(lat, lng,
+                                np.fromiter((r[2] for r in rows), float, len(rows)),
+                                np.fromiter((r[3] for r in rows), float, len(rows)))
+        inside = np.flatnonzero(distances <= radius_m)
+        order = inside[np.argsort(distances[inside], kind='stable')]
+        if limit:
+            order = order[:limit]
+        return [_as_dict(rows[i], distances[i]) for i in order]
+
+    def nearest(self, lat, lng, k, province=None, max_radius_m=NEAREST_MAX_RADIUS_M):
+        # Every point inside the radius is examined, so once k are found they are the true k nearest
+        radius = NEAREST_START_RADIUS_M
+        while True:
+            found = self.within_radius(lat, lng, radius, province=province)
+            if len(found) >= k or radius >= max_radius_m:
+                return found[:k]
+            radius *= 2
+
+
+def _is_supported(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def _as_dict(row, distance=None):
+    data = {'id': row[0], 'name': row[1], 'lat': row[2], 'lng': row[3], 'province': row[4]}
+    if distance is not None:
+        data['distance_m'] = round(float(distance), 1)
+    return data
+
+
+SPATIAL_INDEXES = {
+    'customers': SpatialIndex(CustomerReport, 'customer_geo', CustomerReport.latitude, CustomerReport.longitude),
+    'stores': SpatialIndex(Store, 'store_geo', Store.lat, Store.lng),
+}
+
+
+def ensure_spatial_indexes():
+    """Create the R*Tree tables and backfill any that are still empty."""
+    if not _is_supported(db.engine):
+        return
+    for index in SPATIAL_INDEXES.values():
+        index.ensure()
+    db.session.commit()
+
+
+def remove_province_from_spatial_index(province):
+    """Drop customer entries for a province (bulk deletes bypass the mapper events)."""
+    if not _is_supported(db.engine):
+        return
+    db.session.execute(text(
+        "DELETE FROM customer_geo WHERE id IN (SELECT id FROM customer_report WHERE province = :province)"
+    ), {'province': province})
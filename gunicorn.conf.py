@@ -0,0 +1,74 @@
+"""gunicorn settings; every value can be overridden from the environment.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Workers are forked from a master that has already imported the app and
+preloaded reference data. State that workers share (live positions, cache
+versions, grade weights) lives in the database or in memory-mapped files
+under the instance folder, so requests may land on any worker. ``kill -HUP``
+on the master replaces the workers gracefully; with ``preload_app`` code
+changes need a full restart.
+"""
+import math
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Every open observer map holds a thread for its live location stream, so threads are sized
+# for OBSERVER_STREAMS concurrent observers spread over the workers plus REQUEST_THREADS per
+# worker that streams may never take. Requests are balanced by whichever worker accepts first,
+# hence the 50% headroom on the stream share.
+observer_streams = int(os.environ.get('OBSERVER_STREAMS', 50))
+request_threads = int(os.environ.get('REQUEST_THREADS', 8))
+stream_threads = math.ceil(observer_streams * 1.5 / workers)
+threads = int(os.environ.get('GUNICORN_THREADS', stream_threads + request_threads))
+# Read by the app: a worker refuses new streams (503, the page polls and retries) beyond this
+raw_env = [f'SSE_MAX_STREAMS={max(threads - request_threads, 0)}']
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# Recycle workers now and then so slow leaks in native libraries cannot accumulate
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+
+
+def on_starting(server):
+    from metrics import metrics_store
+
+    # Counters left by the workers of an earlier run would otherwise be added to this run's
+    metrics_store.remove_stale()
+
+
+def post_fork(server, worker):
+    from extentions import db
+    from wsgi import app
+
+    # Preload disposed the pools, but make sure no inherited connection is ever reused
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def on_reload(server):
+    # HUP: refresh the master's copy before new workers are forked from it
+    from wsgi import preload
+
+    preload()
+
+
+def worker_exit(server, worker):
+    from locations import location_buffer, position_store
+
+    # Buffered pings and unsaved positions would otherwise be lost on a graceful restart
+    location_buffer.flush()
+    position_store.checkpoint()
+
+
+def child_exit(server, worker):
+    from metrics import metrics_store
+
+    # Keeps the worker's counts in /metrics without a file per recycled worker
+    metrics_store.absorb(worker.pid)
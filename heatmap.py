@@ -0,0 +1,194 @@
+import threading
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from extentions import db
+from metrics import cache_lookups
+from models import CustomerReport, CustomerEvaluation
+from refdata import UNGRADED, SharedVersion
+
+# Grid covering Iran; cells outside it are ignored
+IRAN_BOUNDS = (25.0, 44.0, 40.0, 64.0)  # min_lat, min_lng, max_lat, max_lng
+# Allowed cell sizes in degrees, which also bounds the number of cached grids
+HEATMAP_RESOLUTIONS = (0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+DEFAULT_RESOLUTION = 0.1
+
+
+class HeatmapGrid:
+    """Per-cell customer counts, grade counts and latest-evaluation score sums."""
+
+    def __init__(self, resolution):
+        import numpy as np
+        self.resolution = resolution
+        min_lat, min_lng, max_lat, max_lng = IRAN_BOUNDS
+        self.lat_edges = np.arange(min_lat, max_lat + resolution / 2, resolution)
+        self.lng_edges = np.arange(min_lng, max_lng + resolution / 2, resolution)
+        shape = (len(self.lat_edges) - 1, len(self.lng_edges) - 1)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.score_sum = np.zeros(shape, dtype=np.float64)
+        self.scored = np.zeros(shape, dtype=np.int64)
+        self.grades = {}
+
+    def _histogram(self, lat, lng, weights=None):
+        import numpy as np
+        hist, _, _ = np.histogram2d(lat, lng, bins=(self.lat_edges, self.lng_edges), weights=weights)
+        return hist
+
+    def add(self, lat, lng, grades, scores):
+        """Accumulate customers given as parallel arrays; NaN scores mean not evaluated."""
+        import numpy as np
+        if not len(lat):
+            return
+        self.count += self._histogram(lat, lng).astype(np.int64)
+        evaluated = ~np.isnan(scores)
+        if evaluated.any():
+            self.score_sum += self._histogram(lat[evaluated], lng[evaluated], scores[evaluated])
+            self.scored += self._histogram(lat[evaluated], lng[evaluated]).astype(np.int64)
+        for grade in np.unique(grades):
+            mask = grades == grade
+            if grade not in self.grades:
+                self.grades[grade] = np.zeros_like(self.count)
+            self.grades[grade] += self._histogram(lat[mask], lng[mask]).astype(np.int64)
+
+    def cells(self):
+        import numpy as np
+        rows, cols = np.nonzero(self.count)
+        half = self.resolution / 2
+        grade_items = list(self.grades.items())
+        result = []
+        for r, c in zip(rows, cols):
+            scored = self.scored[r, c]
+            result.append({
+                'lat': round(float(self.lat_edges[r] + half), 6),
+                'lng': round(float(self.lng_edges[c] + half), 6),
+                'count': int(self.count[r, c]),
+                'grades': {str(g): int(a[r, c]) for g, a in grade_items if a[r, c]},
+                'mean_score': round(float(self.score_sum[r, c] / scored), 2) if scored else None,
+            })
+        return result
+
+
+def _customer_arrays(rows):
+    import numpy as np
+    lat = np.fromiter((r[0] for r in rows), np.float64, len(rows))
+    lng = np.fromiter((r[1] for r in rows), np.float64, len(rows))
+    grades = np.array([r[2] or UNGRADED for r in rows], dtype=object)
+    scores = np.fromiter((np.nan if r[3] is None else r[3] for r in rows), np.float64, len(rows))
+    return lat, lng, grades, scores
+
+
+def build_heatmap(province, resolution):
+    # Latest evaluation per customer, taken as the highest id
+    latest = db.session.query(
+        CustomerEvaluation.customer_id, func.max(CustomerEvaluation.id).label('evaluation_id')
+    ).group_by(CustomerEvaluation.customer_id).subquery()
+
+    query = db.session.query(
+        CustomerReport.latitude, CustomerReport.longitude, CustomerReport.grade, CustomerEvaluation.total_score
+    ).outerjoin(latest, latest.c.customer_id == CustomerReport.id) \
+        .outerjoin(CustomerEvaluation, CustomerEvaluation.id == latest.c.evaluation_id) \
+        .filter(CustomerReport.latitude.isnot(None), CustomerReport.longitude.isnot(None))
+    if province:
+        query = query.filter(CustomerReport.province == province)
+
+    grid = HeatmapGrid(resolution)
+    grid.add(*_customer_arrays(query.all()))
+    return grid
+
+
+# --------------------- Cache and incremental maintenance ---------------------
+_grids = {}
+_lock = threading.Lock()
+_shared = SharedVersion('heatmap')
+
+
+def get_heatmap(province=None, resolution=DEFAULT_RESOLUTION):
+    if _shared.moved():
+        # Another worker committed customer or evaluation changes
+        with _lock:
+            _grids.clear()
+    key = (province, resolution)
+    grid = _grids.get(key)
+    if grid is None:
+        with _lock:
+            grid = _grids.get(key)
+            if grid is None:
+                cache_lookups.inc('heatmap', 'miss')
+                grid = _grids[key] = build_heatmap(province, resolution)
+                return grid
+    cache_lookups.inc('heatmap', 'hit')
+    return grid
+
+
+def _pending(session):
+    return session.info.setdefault('heatmap_changes', {'added': [], 'stale': set()})
+
+
+def _record_insert(mapper, connection, target):
+    if target.latitude is not None and target.longitude is not None:
+        _pending(db.inspect(target).session)['added'].append(
+            (target.latitude, target.longitude, target.grade, None, target.province)
+        )
+
+
+def _record_update(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[f].history.has_changes() for f in ('latitude', 'longitude', 'grade', 'province')):
+        stale = _pending(state.session)['stale']
+        stale.add(target.province)
+        stale.update(p for p in state.attrs.province.history.deleted if p)
+
+
+def _record_delete(mapper, connection, target):
+    _pending(db.inspect(target).session)['stale'].add(target.province)
+
+
+def _record_evaluation(mapper, connection, target):
+    # The evaluation's own province column is optional, so every grid is refreshed
+    _pending(db.inspect(target).session)['stale'].add('*')
+
+
+def mark_heatmap_province_changed(province):
+    """Record a bulk change that bypassed the mapper events; applied on commit."""
+    _pending(db.session())['stale'].add(province)
+
+
+event.listen(CustomerReport, 'after_insert', _record_insert)
+event.listen(CustomerReport, 'after_update', _record_update)
+event.listen(CustomerReport, 'after_delete', _record_delete)
+event.listen(CustomerEvaluation, 'after_insert', _record_evaluation)
+event.listen(CustomerEvaluation, 'after_update', _record_evaluation)
+event.listen(CustomerEvaluation, 'after_delete', _record_evaluation)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed(session):
+    changes = session.info.pop('heatmap_changes', None)
+    if not changes:
+        return
+    _apply_changes(changes)
+    _shared.publish()
+
+
+def _apply_changes(changes):
+    with _lock:
+        stale = changes['stale']
+        for key in list(_grids):
+            province = key[0]
+            if '*' in stale or (province is None and stale) or province in stale:
+                del _grids[key]
+
+        # Imported customers are only added, so cached grids absorb them in place
+        added = changes['added']
+        if not added:
+            return
+        for (province, _), grid in _grids.items():
+            rows = [row[:4] for row in added if province is None or row[4] == province]
+            if rows:
+                grid.add(*_customer_arrays(rows))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('heatmap_changes', None)
@@ -0,0 +1,112 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from extentions import db
+from metrics import cache_lookups
+from models import User
+from refdata import SharedVersion
+
+
+class Identity:
+    """The parts of a logged-in user that authorization and page headers need.
+
+    Returned by the login manager's user loader instead of a ``User`` row,
+    so it is detached from every session and safe to share between requests.
+    """
+    __slots__ = ('id', 'username', 'fullname', 'role', 'is_active')
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, username, fullname, role, is_active):
+        self.id = id
+        self.username = username
+        self.fullname = fullname
+        self.role = role
+        self.is_active = is_active
+
+    def get_id(self):
+        return str(self.id)
+
+    def __repr__(self):
+        return f'<Identity {self.username}, role={self.role}>'
+
+
+class IdentityCache:
+    """Per-process cache of ``Identity`` by user id.
+
+    Entries live for ``USER_CACHE_SECONDS``. Committing a change to a user
+    row through the ORM drops them here and, through the shared ``identity``
+    version, in every other worker; the TTL only bounds changes made
+    outside the app.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._shared = SharedVersion('identity')
+        self.ttl = 30
+
+    def init_app(self, app):
+        self.ttl = app.config.get('USER_CACHE_SECONDS', 30)
+        self._clear()
+
+    def _clear(self):
+        with self._lock:
+            self._entries = {}
+            self._generation += 1
+
+    def invalidate(self):
+        self._clear()
+        self._shared.publish()
+
+    def load(self, user_id):
+        if self._shared.moved():
+            self._clear()
+        # A commit while the row is read bumps the generation, so the stale row is not cached
+        generation = self._generation
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            cache_lookups.inc('identity', 'hit')
+            return entry[1]
+        cache_lookups.inc('identity', 'miss')
+        row = db.session.query(User.id, User.username, User.fullname, User.role, User.is_active) \
+            .filter(User.id == user_id).first()
+        if row is None:
+            # Not cached: SQLite reuses the ids of deleted users
+            self._entries.pop(user_id, None)
+            return None
+        identity = Identity(*row)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, identity)
+        return identity
+
+
+identity_cache = IdentityCache()
+
+
+def _record_change(mapper, connection, target):
+    state = db.inspect(target)
+    if state.session is not None:
+        state.session.info['identities_changed'] = True
+
+
+event.listen(User, 'after_update', _record_change)
+event.listen(User, 'after_delete', _record_change)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    if session.info.pop('identities_changed', None):
+        identity_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('identities_changed', None)
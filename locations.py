@@ -0,0 +1,658 @@
+import atexit
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, insert, update
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process deployments only
+    fcntl = None
+
+from extentions import db
+from geo import deadband_mask
+from metrics import location_buffer_pending
+from models import LocationPing, User
+from visits import visit_detector
+
+logger = logging.getLogger(__name__)
+
+# Unflushed pings kept after repeated write failures, so a dead database cannot exhaust memory
+MAX_BUFFERED_PINGS = 100000
+
+# Undelivered update batches per live subscriber before it is dropped (it reconnects)
+SUBSCRIBER_QUEUE_SIZE = 256
+# How often the publisher checks the position store for moved marketers
+PUBLISH_POLL_SECONDS = 0.5
+
+# Offline uploads: how far device clocks may run ahead, and how old a point may be
+BATCH_MAX_CLOCK_SKEW = timedelta(minutes=5)
+BATCH_MAX_AGE = timedelta(days=7)
+
+
+def parse_device_time(value):
+    """Parse a device timestamp given as epoch seconds/milliseconds or ISO 8601; None if absent."""
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        seconds = value / 1000 if value > 1e11 else value
+        return datetime.fromtimestamp(seconds, tz=timezone.utc)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def plausible_device_time(device_time, now):
+    """Whether a device time lies in the window offline uploads accept.
+
+    A time far in the future would make visit detection ignore every later
+    ping of the marketer, so such pings are rejected rather than stored.
+    """
+    return now - BATCH_MAX_AGE <= device_time <= now + BATCH_MAX_CLOCK_SKEW
+
+
+class LocationBuffer:
+    """Write-behind buffer for marketer location pings.
+
+    Requests only append to an in-memory list. A background thread writes the
+    pings to the history table in one batched insert every
+    ``LOCATION_FLUSH_INTERVAL_MS`` or as soon as ``LOCATION_FLUSH_MAX_PINGS``
+    are waiting. Pings that moved less than ``LOCATION_DEADBAND_METERS`` within
+    ``LOCATION_DEADBAND_SECONDS`` of the marketer's last stored ping are not
+    written. Current positions live in the ``position_store``.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._pid = None
+        self._exit_registered = False
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config.get('LOCATION_FLUSH_INTERVAL_MS', 1000) / 1000
+        self.max_pings = app.config.get('LOCATION_FLUSH_MAX_PINGS', 500)
+        self.deadband_m = app.config.get('LOCATION_DEADBAND_METERS', 0)
+        self.deadband_s = app.config.get('LOCATION_DEADBAND_SECONDS', 0)
+        self._reset()
+        # Once per process; create_app() runs again in tests and scratch apps
+        if not self._exit_registered:
+            atexit.register(self.flush)
+            self._exit_registered = True
+
+    def _reset(self):
+        # Threads and locks do not survive fork(), so every process gets its own
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._thread = None
+        # Last stored (lat, lng, ts) per marketer, the reference for the dead-band
+        self._last_kept = {}
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='location-flush', daemon=True)
+                    self._thread.start()
+
+    def push(self, marketer_id, lat, lng, accuracy=None, device_time=None, server_time=None):
+        self._ensure_worker()
+        ping = {
+            'marketer_id': marketer_id,
+            'lat': lat,
+            'lng': lng,
+            'accuracy': accuracy,
+            'device_time': device_time,
+            'server_time': server_time or datetime.now(timezone.utc),
+        }
+        with self._lock:
+            self._pending.append(ping)
+            full = len(self._pending) >= self.max_pings
+            location_buffer_pending.set(len(self._pending))
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Location flush failed')
+
+    def flush(self):
+        """Write every buffered ping; safe to call from any thread."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            pings, self._pending = self._pending, []
+            location_buffer_pending.set(0)
+        if not pings:
+            return
+
+        kept, last_kept = self._deadband(pings)
+        with self.app.app_context():
+            try:
+                if kept:
+                    write_pings(kept)
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Keep the batch for the next attempt, newest pings first if we must drop some
+                with self._lock:
+                    self._pending = (pings + self._pending)[-MAX_BUFFERED_PINGS:]
+                    location_buffer_pending.set(len(self._pending))
+                raise
+            else:
+                # Only stored pings may become the reference, or a retry would drop itself
+                self._last_kept.update(last_kept)
+            finally:
+                db.session.remove()
+
+    def _deadband(self, pings):
+        """Split off the pings worth storing; returns them and the new reference per marketer."""
+        import numpy as np
+        if not self.deadband_m:
+            return pings, {}
+        by_marketer = {}
+        for ping in pings:
+            by_marketer.setdefault(ping['marketer_id'], []).append(ping)
+
+        kept, last_kept = [], {}
+        for marketer_id, group in by_marketer.items():
+            group.sort(key=lambda p: p['server_time'])
+            lat = np.fromiter((p['lat'] for p in group), np.float64, len(group))
+            lng = np.fromiter((p['lng'] for p in group), np.float64, len(group))
+            ts = np.fromiter((p['server_time'].timestamp() for p in group), np.float64, len(group))
+            mask = deadband_mask(lat, lng, ts, self.deadband_m, self.deadband_s,
+                                 anchor=self._last_kept.get(marketer_id))
+            selected = np.flatnonzero(mask)
+            if len(selected):
+                kept.extend(group[i] for i in selected)
+                last = selected[-1]
+                last_kept[marketer_id] = (lat[last], lng[last], ts[last])
+        return kept, last_kept
+
+
+def write_pings(pings):
+    """Insert ping dicts into the location history in one statement and detect visits."""
+    db.session.execute(insert(LocationPing), pings)
+    visit_detector.record(pings)
+
+
+def _as_float(value):
+    import numpy as np
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _as_epoch(value):
+    import numpy as np
+    try:
+        parsed = parse_device_time(value)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return np.nan
+    return parsed.timestamp() if parsed else np.nan
+
+
+def ingest_batch(marketer_id, points, deadband_m=0, deadband_s=0):
+    """Validate, deduplicate and store a batch of offline points in one transaction.
+
+    Points are dicts with ``lat``, ``lng``, ``timestamp`` and an optional
+    ``accuracy``. Points inside the dead-band of the previous kept point are
+    dropped, and points already stored for the marketer (a replayed upload)
+    are skipped. Stored points feed visit detection. The caller commits.
+
+    Returns ``(stats, newest)`` where ``newest`` is the latest valid point as a
+    ping dict (stored or not), or None if there was none.
+    """
+    import numpy as np
+    received = len(points)
+    lat = np.fromiter((_as_float(p.get('lat')) for p in points), np.float64, received)
+    lng = np.fromiter((_as_float(p.get('lng')) for p in points), np.float64, received)
+    ts = np.fromiter((_as_epoch(p.get('timestamp')) for p in points), np.float64, received)
+    accuracy = np.fromiter((_as_float(p.get('accuracy')) for p in points), np.float64, received)
+
+    now = datetime.now(timezone.utc)
+    with np.errstate(invalid='ignore'):
+        valid = (np.isfinite(lat) & np.isfinite(lng) & np.isfinite(ts)
+                 & (np.abs(lat) <= 90) & (np.abs(lng) <= 180)
+                 & (ts <= (now + BATCH_MAX_CLOCK_SKEW).timestamp())
+                 & (ts >= (now - BATCH_MAX_AGE).timestamp()))
+    idx = np.flatnonzero(valid)
+    invalid = received - len(idx)
+
+    # Same millisecond at the same ~10 cm position counts as one point; the result is time-ordered
+    keys = np.stack([np.round(ts[idx] * 1000), np.round(lat[idx] * 1e6), np.round(lng[idx] * 1e6)], axis=1)
+    _, first = np.unique(keys.astype(np.int64), axis=0, return_index=True)
+    idx = idx[np.sort(first)]
+    idx = idx[np.argsort(ts[idx], kind='stable')]
+
+    newest = None
+    if len(idx):
+        last = idx[-1]
+        newest = {'marketer_id': marketer_id, 'lat': float(lat[last]), 'lng': float(lng[last]),
+                  'device_time': datetime.fromtimestamp(ts[last], tz=timezone.utc)}
+
+    # Filtered before the replay check, so a replayed upload keeps exactly the same points
+    unique = len(idx)
+    if deadband_m and len(idx):
+        idx = idx[deadband_mask(lat[idx], lng[idx], ts[idx], deadband_m, deadband_s)]
+    filtered = unique - len(idx)
+
+    if len(idx):
+        window = (datetime.fromtimestamp(ts[idx[0]], tz=timezone.utc),
+                  datetime.fromtimestamp(ts[idx[-1]], tz=timezone.utc))
+        stored = db.session.query(LocationPing.device_time).filter(
+            LocationPing.marketer_id == marketer_id,
+            LocationPing.device_time.between(*window)
+        ).all()
+        if stored:
+            stored_ms = np.array([round(_utc(t).timestamp() * 1000) for (t,) in stored], dtype=np.int64)
+            idx = idx[~np.isin(np.round(ts[idx] * 1000).astype(np.int64), stored_ms)]
+
+    duplicates = received - invalid - filtered - len(idx)
+    if len(idx):
+        rows = [{
+            'marketer_id': marketer_id,
+            'lat': float(lat[i]),
+            'lng': float(lng[i]),
+            'accuracy': None if np.isnan(accuracy[i]) else float(accuracy[i]),
+            'device_time': datetime.fromtimestamp(ts[i], tz=timezone.utc),
+            'server_time': now,
+        } for i in idx]
+        write_pings(rows)
+
+    stats = {'received': received, 'accepted': int(len(idx)), 'duplicates': int(duplicates),
+             'filtered': int(filtered), 'invalid': int(invalid)}
+    return stats, newest
+
+
+def _utc(value):
+    # SQLite hands DateTime values back naive; they were written as UTC
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def marketer_location(marketer_id, name, lat, lng, last_update):
+    """The JSON shape served to the observer map for one marketer."""
+    return {
+        'id': marketer_id,
+        'name': name,
+        'lat': lat,
+        'lng': lng,
+        'last_update': last_update.strftime('%Y-%m-%d %H:%M:%S') if last_update else None
+    }
+
+
+# Shared store layout: a header, then one fixed-size slot per user id
+_STORE_MAGIC = 0x31534F50544B4D  # "MKTPOS1"
+_HEADER = struct.Struct('<QQQQ')  # magic, capacity, version, roster version
+_HEADER_SIZE = 64
+_SEQ = struct.Struct('<Q')
+_POSITION = struct.Struct('<ddd')  # lat, lng, epoch seconds (0 = no position)
+_SLOT_SIZE = _SEQ.size + _POSITION.size
+_READ_RETRIES = 100
+
+
+class PositionStore:
+    """Last known marketer positions, shared by every worker process.
+
+    Positions live in a memory-mapped file with one slot per user id, so a ping
+    taken by any worker is visible to all of them without touching the ``user``
+    table. Readers never lock: each slot carries a sequence number that is odd
+    while a write is in progress (a seqlock), and readers retry torn reads.
+    Writers serialize on a file lock. A header counter is bumped on every
+    write, which gives cheap change detection for ETags and the publisher.
+
+    ``User.current_*`` is only a checkpoint, written every
+    ``LOCATION_CHECKPOINT_SECONDS`` for the marketers this process moved.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._pid = None
+        self._mm = None
+        self._roster = (None, {})
+        self._exit_registered = False
+
+    def init_app(self, app):
+        self.app = app
+        self.path = app.config.get('POSITION_STORE_PATH') or os.path.join(app.instance_path, 'positions.bin')
+        self.capacity = app.config.get('POSITION_STORE_CAPACITY', 65536)
+        self.checkpoint_interval = app.config.get('LOCATION_CHECKPOINT_SECONDS', 30)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._reset()
+
+        size = _HEADER_SIZE + self.capacity * _SLOT_SIZE
+        with self._locked():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+            magic, capacity, _, _ = _HEADER.unpack_from(self._mm, 0)
+            if magic != _STORE_MAGIC or capacity != self.capacity:
+                self._mm[:] = bytes(size)
+                # Versions start from the clock so a recreated file never repeats an old ETag
+                now_ms = int(time.time() * 1000)
+                _HEADER.pack_into(self._mm, 0, _STORE_MAGIC, self.capacity, now_ms, now_ms)
+        if not self._exit_registered:
+            atexit.register(self.checkpoint)
+            self._exit_registered = True
+
+    def _reset(self):
+        # Lock files are per open file description, so every process reopens its own
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._thread = None
+
+    def _ensure_process(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    # --------------------- Slots ---------------------
+    def _offset(self, marketer_id):
+        if not 0 < marketer_id < self.capacity:
+            return None
+        return _HEADER_SIZE + marketer_id * _SLOT_SIZE
+
+    def _read(self, offset):
+        """Return ``(seq, lat, lng, ts)`` for a slot without locking."""
+        for _ in range(_READ_RETRIES):
+            seq = _SEQ.unpack_from(self._mm, offset)[0]
+            if not seq & 1:
+                position = _POSITION.unpack_from(self._mm, offset + _SEQ.size)
+                if _SEQ.unpack_from(self._mm, offset)[0] == seq:
+                    return (seq,) + position
+            time.sleep(0)
+        # A writer that died mid-write leaves the slot odd; the lock lets us read and repair it
+        self._ensure_process()
+        with self._locked():
+            seq = _SEQ.unpack_from(self._mm, offset)[0]
+            if seq & 1:
+                seq += 1
+                _SEQ.pack_into(self._mm, offset, seq)
+            return (seq,) + _POSITION.unpack_from(self._mm, offset + _SEQ.size)
+
+    def _write(self, offset, lat, lng, ts):
+        seq = _SEQ.unpack_from(self._mm, offset)[0] | 1
+        _SEQ.pack_into(self._mm, offset, seq)
+        _POSITION.pack_into(self._mm, offset + _SEQ.size, lat, lng, ts)
+        _SEQ.pack_into(self._mm, offset, seq + 1)
+
+    def _bump(self, field):
+        # Header fields are consecutive 64-bit counters
+        _SEQ.pack_into(self._mm, 8 * field, _SEQ.unpack_from(self._mm, 8 * field)[0] + 1)
+
+    @property
+    def version(self):
+        return _HEADER.unpack_from(self._mm, 0)[2]
+
+    @property
+    def roster_version(self):
+        return _HEADER.unpack_from(self._mm, 0)[3]
+
+    def update(self, marketer_id, lat, lng, when, only_if_newer=False, checkpoint=True):
+        """Move a marketer; returns False if ``only_if_newer`` kept a fresher position."""
+        offset = self._offset(marketer_id)
+        if offset is None:
+            logger.error('User id %s is outside the position store capacity', marketer_id)
+            return False
+        ts = when.timestamp()
+        self._ensure_process()
+        with self._locked():
+            if only_if_newer and self._read(offset)[3] >= ts:
+                return False
+            self._write(offset, lat, lng, ts)
+            self._bump(2)
+        if checkpoint:
+            self._mark_dirty(marketer_id)
+        return True
+
+    def clear(self, marketer_id):
+        """Forget a deleted user's position, since SQLite may reuse the id."""
+        offset = self._offset(marketer_id)
+        if offset is None:
+            return
+        self._ensure_process()
+        with self._locked():
+            self._write(offset, 0.0, 0.0, 0.0)
+            self._bump(2)
+
+    def get(self, marketer_id):
+        """Return ``(lat, lng, when)`` or None if the marketer has no position."""
+        offset = self._offset(marketer_id)
+        if offset is None:
+            return None
+        _, lat, lng, ts = self._read(offset)
+        return (lat, lng, datetime.fromtimestamp(ts, tz=timezone.utc)) if ts else None
+
+    # --------------------- Roster ---------------------
+    def roster(self):
+        """Marketer id to display name, reloaded only after ``roster_changed``."""
+        version = self.roster_version
+        cached_version, names = self._roster
+        if cached_version != version:
+            marketers = db.session.query(User.id, User.fullname, User.username).filter(User.role == 'marketer')
+            names = {m.id: m.fullname or m.username for m in marketers}
+            self._roster = (version, names)
+        return names
+
+    def roster_changed(self):
+        """Tell every process that marketers were added, renamed or deleted."""
+        self._ensure_process()
+        with self._locked():
+            self._bump(3)
+            self._bump(2)
+
+    def snapshot(self, names, since=None):
+        """Observer map entries for ``names``; returns ``(entries, last_modified)``."""
+        entries = []
+        last_modified = None
+        for marketer_id, name in names.items():
+            position = self.get(marketer_id)
+            if position is None:
+                if since is None:
+                    entries.append(marketer_location(marketer_id, name, None, None, None))
+                continue
+            lat, lng, when = position
+            if last_modified is None or when > last_modified:
+                last_modified = when
+            if since is None or when > since:
+                entries.append(marketer_location(marketer_id, name, lat, lng, when))
+        return entries, last_modified
+
+    def changes(self, names, seen):
+        """Entries whose slot changed since ``seen`` (id to sequence), which is updated."""
+        changed = []
+        for marketer_id, name in names.items():
+            offset = self._offset(marketer_id)
+            if offset is None:
+                continue
+            seq, lat, lng, ts = self._read(offset)
+            if seen.get(marketer_id) != seq:
+                seen[marketer_id] = seq
+                if ts:
+                    changed.append(marketer_location(marketer_id, name, lat, lng,
+                                                     datetime.fromtimestamp(ts, tz=timezone.utc)))
+        return changed
+
+    # --------------------- Database checkpoint ---------------------
+    def load_from_db(self):
+        """Seed the store from the checkpointed columns where they are newer."""
+        marketers = db.session.query(
+            User.id, User.current_lat, User.current_lng, User.last_location_update
+        ).filter(User.role == 'marketer', User.current_lat.isnot(None), User.current_lng.isnot(None),
+                 User.last_location_update.isnot(None))
+        for m in marketers:
+            self.update(m.id, m.current_lat, m.current_lng, _utc(m.last_location_update),
+                        only_if_newer=True, checkpoint=False)
+
+    def _mark_dirty(self, marketer_id):
+        with self._lock:
+            self._dirty.add(marketer_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='position-checkpoint', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint()
+            except Exception:
+                logger.exception('Position checkpoint failed')
+
+    def checkpoint(self):
+        """Write the positions this process changed to ``User.current_*``."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            marketer_ids, self._dirty = self._dirty, set()
+        rows = []
+        for marketer_id in marketer_ids:
+            position = self.get(marketer_id)
+            if position:
+                rows.append({'marketer_id': marketer_id, 'lat': position[0], 'lng': position[1],
+                             'updated_at': position[2]})
+        if not rows:
+            return
+
+        users = User.__table__
+        with self.app.app_context():
+            try:
+                db.session.execute(
+                    update(users).where(users.c.id == bindparam('marketer_id')).values(
+                        current_lat=bindparam('lat'), current_lng=bindparam('lng'),
+                        last_location_update=bindparam('updated_at')),
+                    rows
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._dirty |= marketer_ids
+                raise
+            finally:
+                db.session.remove()
+
+
+class LocationPublisher:
+    """Fans marketer position changes out to live subscribers.
+
+    While anyone is subscribed, a watcher thread polls the position store's
+    version every ``PUBLISH_POLL_SECONDS`` and pushes the marketers whose slot
+    changed, so pings taken by any worker reach every open observer map and no
+    query is made. Each subscriber gets its own bounded queue of update
+    batches; a subscriber that falls behind is dropped and reconnects, as are
+    all of them when the roster changes.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._names = {}
+        self._seen = {}
+        self._version = None
+        self._roster_version = None
+
+    def subscribe(self):
+        """Register a subscriber; returns its queue and the current snapshot."""
+        names = self.store.roster()
+        with self._lock:
+            subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._names = names
+                self._roster_version = self.store.roster_version
+                self._version = self.store.version
+                self._seen = {}
+                self.store.changes(names, self._seen)
+                self._thread = threading.Thread(target=self._watch, name='location-publisher', daemon=True)
+                self._thread.start()
+        # Taken after registering, so nothing that moves from here on can be missed
+        snapshot, _ = self.store.snapshot(names)
+        return subscriber, snapshot
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _watch(self):
+        while True:
+            time.sleep(PUBLISH_POLL_SECONDS)
+            try:
+                with self._lock:
+                    if not self._subscribers or not self._poll():
+                        self._thread = None
+                        return
+            except Exception:
+                logger.exception('Location publishing failed')
+
+    def _poll(self):
+        """Push changed positions; returns False once the watcher should stop."""
+        version = self.store.version
+        if version == self._version:
+            return True
+        self._version = version
+        if self.store.roster_version != self._roster_version:
+            # Names or membership changed: clients reconnect and get a fresh snapshot
+            for subscriber in self._subscribers:
+                _close_subscriber(subscriber)
+            self._subscribers.clear()
+            return False
+
+        changed = self.store.changes(self._names, self._seen)
+        if not changed:
+            return True
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.put_nowait(changed)
+            except queue.Full:
+                self._subscribers.discard(subscriber)
+                _close_subscriber(subscriber)
+        return True
+
+
+def _close_subscriber(subscriber):
+    # Replace whatever is queued with the end-of-stream marker; the client reconnects
+    try:
+        while True:
+            subscriber.get_nowait()
+    except queue.Empty:
+        pass
+    subscriber.put_nowait(None)
+
+
+position_store = PositionStore()
+location_buffer = LocationBuffer()
+location_publisher = LocationPublisher(position_store)
@@ -0,0 +1,190 @@
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from extentions import db
+from metrics import cache_lookups
+from models import CustomerReport
+from refdata import UNGRADED, SharedVersion
+
+# Grid cell edge in screen pixels; a power-of-two fraction of the 256px tile keeps
+# every cell at zoom z exactly the union of four cells at zoom z + 1
+CLUSTER_CELL_PX = 64
+# Above this zoom individual customers are returned instead of clusters
+CLUSTER_MAX_ZOOM = 14
+MAX_POINTS_PER_VIEW = 5000
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def _mercator(lat, lng):
+    """Project to normalized Web Mercator coordinates in [0, 1)."""
+    import numpy as np
+    lat = np.radians(np.clip(lat, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    x = (lng + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0
+    return np.clip(x, 0.0, 1.0 - 1e-12), np.clip(y, 0.0, 1.0 - 1e-12)
+
+
+def _grid_size(zoom):
+    return (256 // CLUSTER_CELL_PX) << zoom
+
+
+class ClusterPyramid:
+    """Grid clusters for every zoom level of one province, aggregated bottom-up."""
+
+    def __init__(self, ids, lat, lng, grade_codes, grade_labels):
+        self.ids = ids
+        self.lat = lat
+        self.lng = lng
+        self.grade_codes = grade_codes
+        self.grade_labels = grade_labels
+        self.levels = {}
+        if len(ids):
+            self._build()
+
+    def _build(self):
+        import numpy as np
+        n_grades = len(self.grade_labels)
+        x, y = _mercator(self.lat, self.lng)
+        size = _grid_size(CLUSTER_MAX_ZOOM)
+        cx = (x * size).astype(np.int64)
+        cy = (y * size).astype(np.int64)
+        count = np.ones(len(self.ids), dtype=np.int64)
+        lat_sum, lng_sum = self.lat, self.lng
+        grades = np.zeros((len(self.ids), n_grades), dtype=np.int64)
+        grades[np.arange(len(self.ids)), self.grade_codes] = 1
+
+        for zoom in range(CLUSTER_MAX_ZOOM, -1, -1):
+            keys = cx * _grid_size(zoom) + cy
+            uniq, inverse = np.unique(keys, return_inverse=True)
+            n = len(uniq)
+            count = np.bincount(inverse, weights=count, minlength=n).astype(np.int64)
+            lat_sum = np.bincount(inverse, weights=lat_sum, minlength=n)
+            lng_sum = np.bincount(inverse, weights=lng_sum, minlength=n)
+            grades = np.stack(
+                [np.bincount(inverse, weights=grades[:, g], minlength=n) for g in range(n_grades)], axis=1
+            ).astype(np.int64)
+            # Cached levels are kept in 32-bit form; float32 is well under a meter here
+            self.levels[zoom] = ((lat_sum / count).astype(np.float32), (lng_sum / count).astype(np.float32),
+                                 count.astype(np.int32), grades.astype(np.int32))
+            cx, cy = uniq // _grid_size(zoom) // 2, uniq % _grid_size(zoom) // 2
+
+    def clusters(self, zoom, min_lat, min_lng, max_lat, max_lng):
+        import numpy as np
+        if zoom not in self.levels:
+            return []
+        lat, lng, count, grades = self.levels[zoom]
+        mask = (lat >= min_lat) & (lat <= max_lat) & (lng >= min_lng) & (lng <= max_lng)
+        return [{
+            'lat': float(lat[i]),
+            'lng': float(lng[i]),
+            'count': int(count[i]),
+            'grades': {self.grade_labels[g]: int(grades[i, g]) for g in np.flatnonzero(grades[i])},
+        } for i in np.flatnonzero(mask)]
+
+    def points(self, min_lat, min_lng, max_lat, max_lng, limit=MAX_POINTS_PER_VIEW):
+        import numpy as np
+        mask = (self.lat >= min_lat) & (self.lat <= max_lat) & (self.lng >= min_lng) & (self.lng <= max_lng)
+        selected = np.flatnonzero(mask)[:limit]
+        return [{
+            'id': int(self.ids[i]),
+            'lat': float(self.lat[i]),
+            'lng': float(self.lng[i]),
+            'grade': self.grade_labels[self.grade_codes[i]],
+        } for i in selected]
+
+
+def build_pyramid(province=None):
+    import numpy as np
+    query = db.session.query(
+        CustomerReport.id, CustomerReport.latitude, CustomerReport.longitude, CustomerReport.grade
+    ).filter(CustomerReport.latitude.isnot(None), CustomerReport.longitude.isnot(None))
+    if province:
+        query = query.filter(CustomerReport.province == province)
+    rows = query.all()
+
+    ids = np.fromiter((r[0] for r in rows), np.int64, len(rows))
+    lat = np.fromiter((r[1] for r in rows), np.float64, len(rows))
+    lng = np.fromiter((r[2] for r in rows), np.float64, len(rows))
+    grade_labels, grade_codes = np.unique([r[3] or UNGRADED for r in rows], return_inverse=True) \
+        if rows else (np.array([]), np.array([], dtype=np.int64))
+    return ClusterPyramid(ids, lat, lng, grade_codes, [str(g) for g in grade_labels])
+
+
+# --------------------- Per-province cache ---------------------
+_pyramids = {}
+_lock = threading.Lock()
+_shared = SharedVersion('map_clusters')
+
+
+def get_pyramid(province=None):
+    if _shared.moved():
+        # Another worker committed customer changes; which provinces is not recorded
+        with _lock:
+            _pyramids.clear()
+    pyramid = _pyramids.get(province)
+    if pyramid is None:
+        with _lock:
+            pyramid = _pyramids.get(province)
+            if pyramid is None:
+                cache_lookups.inc('map_clusters', 'miss')
+                pyramid = _pyramids[province] = build_pyramid(province)
+                return pyramid
+    cache_lookups.inc('map_clusters', 'hit')
+    return pyramid
+
+
+def invalidate_pyramids(provinces):
+    """Drop cached pyramids for the given provinces and the all-provinces view."""
+    with _lock:
+        for province in set(provinces) | {None}:
+            _pyramids.pop(province, None)
+
+
+_MAP_FIELDS = ('latitude', 'longitude', 'grade', 'province')
+
+
+def _touched_provinces(session):
+    return session.info.setdefault('map_cluster_provinces', set())
+
+
+def _record_change(mapper, connection, target):
+    state = db.inspect(target)
+    if state.session is None:
+        return
+    touched = _touched_provinces(state.session)
+    touched.add(target.province)
+    # A customer moved between provinces invalidates the old one as well
+    touched.update(p for p in state.attrs.province.history.deleted if p)
+
+
+def _record_update(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[f].history.has_changes() for f in _MAP_FIELDS):
+        _record_change(mapper, connection, target)
+
+
+def mark_province_changed(province):
+    """Record a bulk change that bypassed the mapper events; applied on commit."""
+    _touched_provinces(db.session()).add(province)
+
+
+event.listen(CustomerReport, 'after_insert', _record_change)
+event.listen(CustomerReport, 'after_update', _record_update)
+event.listen(CustomerReport, 'after_delete', _record_change)
+
+
+# Invalidate only once the change is committed, so a rebuild can never cache
+# rows from a transaction that is still open or later rolled back
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    touched = session.info.pop('map_cluster_provinces', None)
+    if touched:
+        invalidate_pyramids(touched)
+        _shared.publish()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('map_cluster_provinces', None)
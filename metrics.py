@@ -0,0 +1,337 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process deployments only
+    fcntl = None
+
+from extentions import db
+
+# Each process appends (key length, JSON key, padding, float64 value) entries after a used-bytes header
+_USED = struct.Struct('<Q')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+_INITIAL_FILE_SIZE = 64 * 1024
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_METRICS = {}
+
+
+class _ProcessValues:
+    """This process's samples, in a file of its own that other processes only read."""
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, _INITIAL_FILE_SIZE)
+        self._mm = mmap.mmap(self._fd, _INITIAL_FILE_SIZE)
+        self._used = _USED.size
+        _USED.pack_into(self._mm, 0, self._used)
+        self._offsets = {}
+
+    def add(self, key, amount):
+        offset = self._offsets.get(key) or self._append(key)
+        _VALUE.pack_into(self._mm, offset, _VALUE.unpack_from(self._mm, offset)[0] + amount)
+
+    def set(self, key, value):
+        _VALUE.pack_into(self._mm, self._offsets.get(key) or self._append(key), value)
+
+    def _append(self, key):
+        encoded = json.dumps(key).encode()
+        # Keeps every value 8-byte aligned, so readers never see half of one
+        value_at = (_KEY_LENGTH.size + len(encoded) + 7) // 8 * 8
+        size = value_at + _VALUE.size
+        if self._used + size > len(self._mm):
+            self._mm.resize(max(len(self._mm) * 2, self._used + size))
+        start = self._used
+        _KEY_LENGTH.pack_into(self._mm, start, len(encoded))
+        self._mm[start + _KEY_LENGTH.size:start + _KEY_LENGTH.size + len(encoded)] = encoded
+        _VALUE.pack_into(self._mm, start + value_at, 0.0)
+        # Published last: readers only look at entries below the used mark
+        self._used += size
+        _USED.pack_into(self._mm, 0, self._used)
+        self._offsets[key] = start + value_at
+        return start + value_at
+
+
+def _read_values(path):
+    """Yield ``(key, value)`` from a process's file."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    if len(data) < _USED.size:
+        return
+    used = min(_USED.unpack_from(data, 0)[0], len(data))
+    position = _USED.size
+    while position + _KEY_LENGTH.size <= used:
+        length = _KEY_LENGTH.unpack_from(data, position)[0]
+        value_at = (_KEY_LENGTH.size + length + 7) // 8 * 8
+        if position + value_at + _VALUE.size > used:
+            break
+        key = data[position + _KEY_LENGTH.size:position + _KEY_LENGTH.size + length]
+        yield tuple(json.loads(key)), _VALUE.unpack_from(data, position + value_at)[0]
+        position += value_at + _VALUE.size
+
+
+def _alive(pid):
+    if os.name == 'nt':
+        # os.kill would deliver CTRL_C_EVENT; Windows deployments run one process anyway
+        return pid == os.getpid()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsStore:
+    """Counters, gauges and histograms summed over every worker process.
+
+    Each process writes its samples to ``<pid>.db`` in ``METRICS_DIR``, a
+    memory-mapped file only it writes, so recording a sample is a dict
+    lookup and a store under a process-local lock. ``exposition()`` reads
+    every file and sums them in the Prometheus text format. Counters and
+    histograms of exited processes keep counting (gunicorn's master folds
+    them into its own file, see ``absorb``); gauges only count while their
+    process is alive.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self._pid = None
+        self._values = None
+        self._lock = threading.Lock()
+        self._reset_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+        os.makedirs(self.directory, exist_ok=True)
+        self._pid = None
+
+        app.before_request(_start_request)
+        app.after_request(_finish_request)
+        with app.app_context():
+            for bind, engine in db.engines.items():
+                name = bind or 'default'
+                # Listening on the engine keeps the listeners on the pool it recreates on dispose()
+                event.listen(engine, 'connect', lambda *args, name=name: db_pool_open.inc(name))
+                event.listen(engine, 'close', lambda *args, name=name: db_pool_open.dec(name))
+                event.listen(engine, 'checkout', lambda *args, name=name: db_pool_in_use.inc(name))
+                event.listen(engine, 'checkin', lambda *args, name=name: db_pool_in_use.dec(name))
+
+    def _reset(self):
+        # A forked worker must not write to its parent's file, or the parent's samples count twice
+        self._values = _ProcessValues(os.path.join(self.directory, f'{os.getpid()}.db'))
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _current(self):
+        if self._pid != os.getpid():
+            with self._reset_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        return self._values
+
+    def add(self, key, amount):
+        if self.directory is None:
+            return
+        values = self._current()
+        with self._lock:
+            values.add(key, amount)
+
+    def set(self, key, value):
+        if self.directory is None:
+            return
+        values = self._current()
+        with self._lock:
+            values.set(key, value)
+
+    @contextmanager
+    def _files_locked(self, exclusive=False):
+        """The directory's files as ``(pid, path)``, with ``absorb`` and readers kept apart."""
+        fd = os.open(os.path.join(self.directory, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield [(int(name[:-3]), os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory) if name.endswith('.db') and name[:-3].isdigit()]
+        finally:
+            os.close(fd)
+
+    def collect(self):
+        """Every sample summed over all processes, by key."""
+        totals = defaultdict(float)
+        with self._files_locked() as files:
+            for pid, path in files:
+                alive = _alive(pid)
+                for key, value in _read_values(path):
+                    metric = _METRICS.get(key[0])
+                    if metric is not None and (alive or metric.kind != 'gauge'):
+                        totals[key] += value
+        return totals
+
+    def exposition(self):
+        """All metrics in the Prometheus text format, version 0.0.4."""
+        samples = defaultdict(dict)
+        if self.directory is not None:
+            for key, value in self.collect().items():
+                samples[key[0]][key[1:]] = value
+        lines = []
+        for metric in _METRICS.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            metric.render(samples[metric.name], lines)
+        return '\n'.join(lines) + '\n'
+
+    def absorb(self, pid):
+        """Fold an exited process's counters and histograms into this process's file.
+
+        Called by gunicorn's master for every worker it reaps, so recycled
+        workers do not leave a file behind for every scrape to read.
+        """
+        if self.directory is None:
+            return
+        with self._files_locked(exclusive=True) as files:
+            for file_pid, path in files:
+                if file_pid == pid:
+                    for key, value in _read_values(path):
+                        metric = _METRICS.get(key[0])
+                        if metric is not None and metric.kind != 'gauge':
+                            self.add(key, value)
+                    os.remove(path)
+
+    def remove_stale(self):
+        """Delete the files of processes that are gone, i.e. from an earlier run."""
+        if self.directory is None:
+            return
+        with self._files_locked(exclusive=True) as files:
+            for pid, path in files:
+                if not _alive(pid):
+                    os.remove(path)
+
+
+metrics_store = MetricsStore()
+
+
+# --------------------- Metric types ---------------------
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _METRICS[name] = self
+
+    def render(self, samples, lines):
+        for key, value in sorted(samples.items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key[1:])} {value!r}')
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        metrics_store.add((self.name, '', *labelvalues), amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labelvalues):
+        metrics_store.set((self.name, '', *labelvalues), value)
+
+    def inc(self, *labelvalues, amount=1):
+        metrics_store.add((self.name, '', *labelvalues), amount)
+
+    def dec(self, *labelvalues, amount=1):
+        metrics_store.add((self.name, '', *labelvalues), -amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        # Buckets are stored uncumulated, one per upper bound and the last for +Inf
+        metrics_store.add((self.name, 'bucket', *labelvalues, bisect_left(self.buckets, value)), 1)
+        metrics_store.add((self.name, 'sum', *labelvalues), value)
+
+    def render(self, samples, lines):
+        series = defaultdict(lambda: [[0] * (len(self.buckets) + 1), 0.0])
+        for key, value in samples.items():
+            if key[0] == 'bucket':
+                series[key[1:-1]][0][int(key[-1])] += value
+            else:
+                series[key[1:]][1] += value
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for labelvalues, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = _labels(self.labelnames + ('le',), labelvalues + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {float(cumulative)!r}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {total!r}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labelvalues)} {float(cumulative)!r}')
+
+
+# --------------------- Metrics ---------------------
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response, by endpoint.', ('endpoint', 'method'))
+http_requests = Counter(
+    'http_requests_total', 'Responses sent, by endpoint and status code.', ('endpoint', 'method', 'status'))
+location_pings = Counter(
+    'location_pings_received_total', 'Location points received from marketers.', ('source',))
+location_buffer_pending = Gauge(
+    'location_buffer_pending_pings', 'Live pings waiting for the background writer.')
+csv_rows_imported = Counter(
+    'csv_rows_imported_total', 'Rows stored from uploaded CSV files.', ('kind',))
+evaluation_rows_scored = Counter(
+    'evaluation_rows_scored_total', 'Rows scored by CSV evaluations.')
+db_pool_in_use = Gauge(
+    'db_pool_connections_in_use', 'Database connections checked out of the pool.', ('engine',))
+db_pool_open = Gauge(
+    'db_pool_connections_open', 'Database connections the pools hold open.', ('engine',))
+cache_lookups = Counter(
+    'cache_lookups_total', 'In-process cache lookups, by cache and hit or miss.', ('cache', 'result'))
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _finish_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        http_request_duration.observe(time.perf_counter() - started, endpoint, request.method)
+        http_requests.inc(endpoint, request.method, str(response.status_code))
+    return response
@@ -0,0 +1,203 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+
+from extentions import db
+from models import (
+    CSVEvaluationRecord, CustomerEvaluation, CustomerReport, GradeWeight, LocationPing, ProvinceTarget,
+    RouteAssignment, RoutePoint, SchemaVersion, Store, User, VisitEvent
+)
+
+# Rows updated per transaction by backfills, so writers are never blocked for long
+BACKFILL_BATCH_SIZE = 5000
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register ``upgrade(engine)`` as schema version ``version``.
+
+    Migrations run in version order at startup, each exactly once per
+    database. They must be idempotent: ``db.create_all()`` builds a fresh
+    database straight at the latest models, and two workers starting at once
+    may both run a migration before either records it. An upgrade manages
+    its own transactions so long backfills can commit in batches.
+    """
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return upgrade
+    return register
+
+
+def applied_versions():
+    return set(db.session.execute(select(SchemaVersion.version)).scalars())
+
+
+def pending_migrations():
+    """Versions not applied yet; all of them when the database has never been bootstrapped."""
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return [version for version, _, _ in MIGRATIONS]
+    done = applied_versions()
+    return [version for version, _, _ in MIGRATIONS if version not in done]
+
+
+def run_migrations():
+    """Apply pending migrations; returns the versions applied by this call."""
+    done = applied_versions()
+    # Release the read transaction before DDL; SQLite would otherwise lock against itself
+    db.session.commit()
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version in done:
+            continue
+        upgrade(db.engine)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(SchemaVersion.__table__.insert().values(
+                    version=version, description=description, applied_at=datetime.now(timezone.utc)
+                ))
+        except IntegrityError:
+            pass  # Another worker recorded it first
+        applied.append(version)
+    return applied
+
+
+def _add_column(engine, table, column, ddl_type):
+    columns = {c['name'] for c in inspect(engine).get_columns(table)}
+    if column in columns:
+        return False
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}'))
+    return True
+
+
+def _backfill(engine, table, assignment, condition):
+    """Run ``UPDATE table SET assignment WHERE condition`` a batch at a time."""
+    while True:
+        with engine.begin() as connection:
+            updated = connection.execute(text(
+                f'UPDATE {table} SET {assignment} WHERE id IN '
+                f'(SELECT id FROM {table} WHERE {condition} LIMIT {BACKFILL_BATCH_SIZE})'
+            )).rowcount
+        if not updated:
+            return
+
+
+def _create_index(engine, model, name):
+    """Build one of a model's declared indexes without blocking writes where the database allows."""
+    index = next(i for i in model.__table__.indexes if i.name == name)
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as connection:
+            connection.execute(text(ddl))
+        return
+    # CONCURRENTLY cannot run inside a transaction, and a failed concurrent build
+    # leaves an invalid index behind that IF NOT EXISTS would then skip
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        invalid = connection.execute(text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+        ), {'name': name}).first()
+        if invalid:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+        connection.execute(text(ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)))
+
+
+@migration(1, 'province columns')
+def add_province_columns(engine):
+    # Replaces the old upgrade_customer_report(); these columns predate db.create_all()
+    # on some installs
+    for table in ('customer_report', 'store', 'route', 'customer_evaluation', 'csv_evaluation_record'):
+        _add_column(engine, table, 'province', 'VARCHAR(100)')
+    _backfill(engine, 'customer_report', "province = 'نامشخص'", 'province IS NULL')
+
+
+@migration(2, 'hot-path indexes')
+def add_hot_path_indexes(engine):
+    for model, name in (
+        (CustomerReport, 'ix_customer_report_province'),
+        (CustomerReport, 'ix_customer_report_number'),
+        (CSVEvaluationRecord, 'ix_csv_evaluation_record_batch_id'),
+        (CustomerEvaluation, 'ix_customer_evaluation_batch_evaluated'),
+        (ProvinceTarget, 'ix_province_target_province_latest'),
+        (User, 'ix_user_role'),
+        (User, 'ix_user_last_location_update'),
+        (RoutePoint, 'ix_route_point_route_order'),
+        (RouteAssignment, 'ix_route_assignment_route_id'),
+        (RouteAssignment, 'ix_route_assignment_marketer_id'),
+        (VisitEvent, 'ix_visit_event_assignment_id'),
+    ):
+        _create_index(engine, model, name)
+
+
+@migration(3, 'grade weights table')
+def add_grade_weight_table(engine):
+    # Grade weights used to live in each admin's session, so there is nothing to backfill
+    GradeWeight.__table__.create(engine, checkfirst=True)
+
+
+@migration(4, 'coordinate indexes')
+def add_coordinate_indexes(engine):
+    # SQLite answers viewport queries from its R*Tree tables, built by ensure_spatial_indexes()
+    if engine.dialect.name != 'postgresql':
+        return
+    _create_index(engine, CustomerReport, 'ix_customer_report_lat_lng')
+    _create_index(engine, Store, 'ix_store_lat_lng')
+
+
+# --------------------- Query plans ---------------------
+
+def _hot_queries():
+    recent = datetime.now(timezone.utc) - timedelta(hours=1)
+    return {
+        'customers of a province': select(CustomerReport).where(CustomerReport.province == 'تهران'),
+        'customer by number': select(CustomerReport).where(CustomerReport.number == '1000'),
+        'customers ordered by number': select(CustomerReport).order_by(CustomerReport.number),
+        'CSV evaluation batch ids': select(CSVEvaluationRecord.batch_id).distinct()
+            .where(CSVEvaluationRecord.batch_id.isnot(None)),
+        'CSV evaluation batch rows': select(CSVEvaluationRecord).where(CSVEvaluationRecord.batch_id == 'b'),
+        'latest evaluation of a batch': select(db.func.max(CustomerEvaluation.evaluated_at))
+            .where(CustomerEvaluation.batch_id == 'b'),
+        'latest target of a province': select(ProvinceTarget).where(ProvinceTarget.province_id == 1)
+            .order_by(ProvinceTarget.id.desc()).limit(1),
+        'users by role': select(User).where(User.role == 'marketer'),
+        'recently located users': select(User).where(User.last_location_update >= recent),
+        'points of a route': select(RoutePoint).where(RoutePoint.route_id == 1).order_by(RoutePoint.order),
+        'assignments of a route': select(RouteAssignment).where(RouteAssignment.route_id == 1),
+        'assignments of a marketer': select(RouteAssignment).where(RouteAssignment.marketer_id == 1),
+        'location history of a marketer': select(LocationPing)
+            .where(LocationPing.marketer_id == 1, LocationPing.server_time >= recent),
+        'open visits of a marketer': select(VisitEvent)
+            .where(VisitEvent.marketer_id == 1, VisitEvent.exited_at.is_(None)),
+        'visits of an assignment': select(VisitEvent.route_point_id).where(VisitEvent.assignment_id == 1),
+    }
+
+
+def _plan(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    if connection.dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).all()
+        lines = [row[-1] for row in rows]
+        # "SCAN t" reads the whole table; "SEARCH ... USING INDEX" and "SCAN t USING INDEX" do not
+        return lines, not any(line.startswith('SCAN ') and ' USING ' not in line for line in lines)
+    # Tiny tables make a sequential scan the cheapest plan; rule it out to see whether an index applies
+    connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    lines = [row[0] for row in connection.exec_driver_sql(f'EXPLAIN {compiled}', params)]
+    return lines, not any('Seq Scan' in line for line in lines)
+
+
+def explain_hot_queries():
+    """EXPLAIN each hot query; returns ``(name, uses_index, plan_lines)`` tuples."""
+    results = []
+    with db.engine.connect() as connection:
+        for name, statement in _hot_queries().items():
+            with connection.begin():
+                lines, uses_index = _plan(connection, statement)
+            results.append((name, uses_index, lines))
+    return results
@@ -8,14 +8,14 @@ class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
-    role = db.Column(db.String(20), nullable=False, default='marketer')
+    role = db.Column(db.String(20), nullable=False, default='marketer', index=True)
     email = db.Column(db.String(120), unique=True, nullable=True)
     fullname = db.Column(db.String(120), nullable=True)
     is_active = db.Column(db.Boolean, default=True)
     # Fields for live location updates
     current_lat = db.Column(db.Float, nullable=True)
     current_lng = db.Column(db.Float, nullable=True)
-    last_location_update = db.Column(db.DateTime, nullable=True)
+    last_location_update = db.Column(db.DateTime, nullable=True, index=True)
     assigned_routes = db.relationship('RouteAssignment', backref='marketer', lazy=True)
 
     def __repr__(self):
@@ -48,6 +48,10 @@ class RoutePoint(db.Model):
     order = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
+    __table_args__ = (
+        db.Index('ix_route_point_route_order', 'route_id', 'order'),
+    )
+
     def __repr__(self):
         return f'<RoutePoint {self.name} ({self.latitude}, {self.longitude})>'
 
@@ -55,8 +59,8 @@ class RoutePoint(db.Model):
 class RouteAssignment(db.Model):
     __tablename__ = 'route_assignment'
     id = db.Column(db.Integer, primary_key=True)
-    route_id = db.Column(db.Integer, db.ForeignKey('route.id'), nullable=False)
-    marketer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id'), nullable=False, index=True)
+    marketer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     assigned_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
     is_active = db.Column(db.Boolean, default=True)
     completed = db.Column(db.Boolean, default=False)
@@ -74,6 +78,11 @@ class Store(db.Model):
     lng = db.Column(db.Float, nullable=True)
     province = db.Column(db.String(100), nullable=True)  # Added province field
 
+    __table_args__ = (
+        # Viewport lookups on server databases; SQLite has an R*Tree instead (see geo.py)
+        db.Index('ix_store_lat_lng', 'lat', 'lng').ddl_if(dialect='postgresql'),
+    )
+
     def __repr__(self):
         return f'<Store {self.name} lat={self.lat} lng={self.lng}>'
 
@@ -136,7 +145,7 @@ class CustomerReport(db.Model):
     textbox29 = db.Column(db.String(255), nullable=True)
     caption = db.Column(db.String(255), nullable=True)
     bname = db.Column(db.String(255), nullable=True)
-    number = db.Column(db.String(50), nullable=True)
+    number = db.Column(db.String(50), nullable=True, index=True)
     name = db.Column(db.String(255), nullable=True)
     textbox16 = db.Column(db.String(255), nullable=True)
     textbox12 = db.Column(db.String(255), nullable=True)
@@ -145,9 +154,14 @@ class CustomerReport(db.Model):
     textbox4 = db.Column(db.String(255), nullable=True)
     textbox10 = db.Column(db.String(255), nullable=True)
     grade = db.Column(db.String(10), nullable=True)
-    province = db.Column(db.String(100), nullable=True)  # Province field
+    province = db.Column(db.String(100), nullable=True, index=True)  # Province field
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
+    __table_args__ = (
+        # Viewport lookups on server databases; SQLite has an R*Tree instead (see geo.py)
+        db.Index('ix_customer_report_lat_lng', 'latitude', 'longitude').ddl_if(dialect='postgresql'),
+    )
+
     evaluations = db.relationship('CustomerEvaluation', backref='customer', lazy=True)
     csv_evaluations = db.relationship('CSVEvaluationRecord', backref='customer', lazy=True)
 
@@ -180,6 +194,17 @@ class GradeMapping(db.Model):
         return f'<GradeMapping {self.grade_letter}: {self.min_score}>'
 
 
+class GradeWeight(db.Model):
+    """Allocation weight of a grade on the province targets page; shared by every worker."""
+    __tablename__ = 'grade_weight'
+    id = db.Column(db.Integer, primary_key=True)
+    grade = db.Column(db.String(50), unique=True, nullable=False)
+    weight = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<GradeWeight {self.grade}: {self.weight}>'
+
+
 class CustomerEvaluation(db.Model):
     __tablename__ = 'customer_evaluation'
     id = db.Column(db.Integer, primary_key=True)
@@ -191,6 +216,10 @@ class CustomerEvaluation(db.Model):
     batch_id = db.Column(db.String(50), nullable=True)
     province = db.Column(db.String(100), nullable=True)  # Added province field
 
+    __table_args__ = (
+        db.Index('ix_customer_evaluation_batch_evaluated', 'batch_id', 'evaluated_at'),
+    )
+
     def __repr__(self):
         return f'<CustomerEvaluation customer={self.customer_id}, grade={self.assigned_grade}, score={self.total_score}>'
 
@@ -213,7 +242,7 @@ class CSVEvaluationRecord(db.Model):
     total_score = db.Column(db.Float, nullable=False)
     assigned_grade = db.Column(db.String(10), nullable=False)
     evaluated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    batch_id = db.Column(db.String(50), nullable=True)
+    batch_id = db.Column(db.String(50), nullable=True, index=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer_report.id'), nullable=True)
     province = db.Column(db.String(100), nullable=True)  # Added province field
 
@@ -243,5 +272,76 @@ class ProvinceTarget(db.Model):
     shrink_percentage = db.Column(db.Float, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
+    # Latest target per province: WHERE province_id = ? ORDER BY id DESC LIMIT 1
+    __table_args__ = (
+        db.Index('ix_province_target_province_latest', 'province_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<ProvinceTarget for {self.province.name if self.province else "Unknown"}>'
+
+
+class LocationPing(db.Model):
+    __tablename__ = 'location_ping'
+    id = db.Column(db.Integer, primary_key=True)
+    marketer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    lat = db.Column(db.Float, nullable=False)
+    lng = db.Column(db.Float, nullable=False)
+    accuracy = db.Column(db.Float, nullable=True)  # Reported by the device, in meters
+    device_time = db.Column(db.DateTime, nullable=True)
+    server_time = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_location_ping_marketer_time', 'marketer_id', 'server_time'),
+    )
+
+    def __repr__(self):
+        return f'<LocationPing marketer={self.marketer_id} ({self.lat}, {self.lng})>'
+
+
+class VisitEvent(db.Model):
+    __tablename__ = 'visit_event'
+    id = db.Column(db.Integer, primary_key=True)
+    marketer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    assignment_id = db.Column(db.Integer, db.ForeignKey('route_assignment.id'), nullable=False, index=True)
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id'), nullable=False)
+    route_point_id = db.Column(db.Integer, db.ForeignKey('route_point.id'), nullable=False, index=True)
+    entered_at = db.Column(db.DateTime, nullable=False)
+    last_seen_at = db.Column(db.DateTime, nullable=False)  # Latest ping inside the geofence
+    exited_at = db.Column(db.DateTime, nullable=True)  # NULL while the marketer is still there
+    dwell_seconds = db.Column(db.Float, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_visit_event_marketer_open', 'marketer_id', 'exited_at'),
+    )
+
+    def __repr__(self):
+        return f'<VisitEvent marketer={self.marketer_id} point={self.route_point_id}>'
+
+
+class RouteProgress(db.Model):
+    """Running counters for one route assignment, advanced as visits and pings arrive."""
+    __tablename__ = 'route_progress'
+    assignment_id = db.Column(db.Integer, db.ForeignKey('route_assignment.id'), primary_key=True)
+    points_visited = db.Column(db.Integer, nullable=False, default=0)
+    out_of_order_visits = db.Column(db.Integer, nullable=False, default=0)  # Visited after a later point
+    max_order_visited = db.Column(db.Integer, nullable=True)
+    distance_m = db.Column(db.Float, nullable=False, default=0.0)
+    started_at = db.Column(db.DateTime, nullable=False)  # First visit on the route
+    last_ping_at = db.Column(db.DateTime, nullable=False)
+    last_lat = db.Column(db.Float, nullable=False)
+    last_lng = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<RouteProgress assignment={self.assignment_id} visited={self.points_visited}>'
+
+
+class SchemaVersion(db.Model):
+    """One row per applied migration; see migrations.py."""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
     def __repr__(self):
-        return f'<ProvinceTarget for {self.province.name if self.province else "Unknown"}>'
\ No newline at end of file
+        return f'<SchemaVersion {self.version}: {self.description}>'
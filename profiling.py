@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import time
+import tracemalloc
+import traceback
+from collections import deque
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_THIS_FILE = os.path.abspath(__file__)
+
+
+class RequestProfiler:
+    """Opt-in per-request timing, enabled with ``PROFILING_ENABLED``.
+
+    Every request records its wall time, the number of SQL statements it
+    ran and their total time (from the engine's cursor events), and, with
+    ``PROFILING_TRACE_MEMORY``, the peak of Python allocations while it ran.
+    The last ``PROFILING_SAMPLES`` requests per endpoint are kept for
+    percentiles. Statements slower than ``SLOW_QUERY_MS`` are logged with
+    the line of application code that issued them, from any thread.
+
+    Samples are per process. Streamed responses are timed until the
+    response object is returned, not until the stream ends.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._samples = {}
+        self.slow_queries = deque(maxlen=100)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PROFILING_ENABLED', False)
+        if not self.enabled:
+            return
+        self.root = os.path.abspath(app.root_path) + os.sep
+        self.max_samples = app.config.get('PROFILING_SAMPLES', 1000)
+        self.slow_query_s = app.config.get('SLOW_QUERY_MS', 200) / 1000
+        # tracemalloc slows every allocation, so it is a second opt-in; its peak is process-wide,
+        # so concurrent requests in other threads inflate each other's numbers
+        self.trace_memory = app.config.get('PROFILING_TRACE_MEMORY', False)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'handle_error', self._execute_failed)
+
+    # --------------------- Requests ---------------------
+    def _start(self):
+        g.profile = {'started': time.perf_counter(), 'queries': 0, 'sql_s': 0.0}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+    def _finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None or request.endpoint is None:
+            return response
+        sample = (
+            time.perf_counter() - profile['started'],
+            profile['queries'],
+            profile['sql_s'],
+            tracemalloc.get_traced_memory()[1] if self.trace_memory else 0,
+        )
+        with self._lock:
+            if request.endpoint not in self._samples:
+                self._samples[request.endpoint] = deque(maxlen=self.max_samples)
+            self._samples[request.endpoint].append(sample)
+        return response
+
+    # --------------------- SQL ---------------------
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiling_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profiling_started'].pop()
+        if has_request_context() and 'profile' in g:
+            g.profile['queries'] += 1
+            g.profile['sql_s'] += elapsed
+        if elapsed >= self.slow_query_s:
+            site = self._call_site()
+            statement = ' '.join(statement.split())[:500]
+            self.slow_queries.append({
+                'at': datetime.now(), 'ms': round(elapsed * 1000, 1), 'site': site,
+                'endpoint': request.endpoint if has_request_context() else None,
+                'statement': statement,
+            })
+            logger.warning('Slow query (%.0f ms) at %s: %s', elapsed * 1000, site, statement)
+
+    def _execute_failed(self, context):
+        started = context.connection.info.get('profiling_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _call_site(self):
+        """``file:line in function`` of the innermost application frame that ran the statement."""
+        for frame in reversed(traceback.extract_stack()):
+            filename = os.path.abspath(frame.filename)
+            if filename.startswith(self.root) and filename != _THIS_FILE and 'site-packages' not in filename:
+                return f'{os.path.relpath(filename, self.root)}:{frame.lineno} in {frame.name}'
+        return 'unknown'
+
+    # --------------------- Report ---------------------
+    def summary(self):
+        """Per-endpoint percentiles, slowest p95 first."""
+        import numpy as np
+        with self._lock:
+            samples = {endpoint: np.array(rows) for endpoint, rows in self._samples.items() if rows}
+        rows = []
+        for endpoint, data in samples.items():
+            wall, queries, sql, peak = data.T
+            p50, p95, p99 = np.percentile(wall, (50, 95, 99)) * 1000
+            rows.append({
+                'endpoint': endpoint,
+                'requests': len(data),
+                'p50_ms': round(float(p50), 1),
+                'p95_ms': round(float(p95), 1),
+                'p99_ms': round(float(p99), 1),
+                'queries_mean': round(float(queries.mean()), 1),
+                'queries_max': int(queries.max()),
+                'sql_p95_ms': round(float(np.percentile(sql, 95) * 1000), 1),
+                'peak_alloc_kb': round(float(peak.max()) / 1024) if self.trace_memory else None,
+            })
+        return sorted(rows, key=lambda row: row['p95_ms'], reverse=True)
+
+
+request_profiler = RequestProfiler()
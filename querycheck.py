@@ -0,0 +1,126 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from extentions import db
+from models import CustomerReport, Province, ProvinceTarget, Route, RouteAssignment, RoutePoint, User
+from search import search_customers
+
+# Pages whose query count must not depend on how many rows they show, with the most queries
+# a warm request may issue (a per-province loop stays constant but blows the budget); {route_id}
+# is filled in
+CHECKED_PAGES = {
+    '/admin/routes': 5,
+    '/admin/routes/{route_id}': 3,
+    '/admin/province_targets': 1,
+    '/admin/customers-csv': 1,
+}
+POINTS_PER_ROUTE = 3
+FIXTURE_PROVINCES = 3
+FIXTURE_GRADES = ('A', 'B', None)
+
+# Customers as imported files spell them: (name, bname, number, address, province index), with
+# Arabic ي/ك, Persian digits and a zero-width non-joiner
+SEARCH_FIXTURE = (
+    ('علي كريمي', 'سوپر ماركت نور', '09121234567', 'خيابان آزادی', 0),
+    ('علی کریمی', 'مارکت ستاره', '۰۹۱۳۷۶۵۴۳۲۱', 'خیابان انقلاب', 1),
+    ('رضا احمدی', 'نانوایی', '09351112233', 'میدان کريم\u200cخان', 0),
+)
+# (query, province index or None, indexes of the customers it must find). Queries are word
+# prefixes, which both the FTS5 index and the substring fallback match
+SEARCH_CASES = (
+    ('کریمی', None, {0, 1}),
+    ('كريمي', None, {0, 1}),
+    ('کریم', None, {0, 1, 2}),
+    ('مارکت', None, {0, 1}),
+    ('ماركت ستاره', None, {1}),
+    ('091', None, {0, 1}),
+    ('۰۹۱۲', None, {0}),
+    ('آزادي', None, {0}),
+    ('علی', 0, {0}),
+    ('علی', 1, {1}),
+)
+
+
+def seed_fixture(start, stop):
+    """Add routes (with points and an assigned marketer) and customers numbered ``start``..``stop - 1``."""
+    provinces = Province.query.order_by(Province.id).limit(FIXTURE_PROVINCES).all()
+    for province in provinces:
+        if not ProvinceTarget.query.filter_by(province_id=province.id).count():
+            db.session.add(ProvinceTarget(province_id=province.id, liter_capacity=1000.0, shrink_capacity=100.0))
+    for i in range(start, stop):
+        marketer = User(username=f'querycheck-{i}', password='-', role='marketer', fullname=f'Marketer {i}')
+        route = Route(name=f'Route {i}', province=provinces[i % len(provinces)].name)
+        db.session.add_all((marketer, route))
+        db.session.flush()
+        db.session.add_all(RoutePoint(route_id=route.id, latitude=35.7 + p * 0.01, longitude=51.4, order=p)
+                           for p in range(POINTS_PER_ROUTE))
+        db.session.add(RouteAssignment(route_id=route.id, marketer_id=marketer.id, completed=bool(i % 2)))
+        for province in provinces:
+            db.session.add(CustomerReport(name=f'Customer {i}', number=str(i), province=province.name,
+                                          grade=FIXTURE_GRADES[i % len(FIXTURE_GRADES)], latitude=35.7,
+                                          longitude=51.4))
+    db.session.commit()
+
+
+def _count_queries(client, path):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # The first request fills the per-process caches; the second shows the steady state
+    client.get(path)
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        status = client.get(path).status_code
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+    return status, len(statements)
+
+
+def page_query_counts(app, small, large, username='admin', password='adminpassword'):
+    """Query counts of every checked page with ``small`` and then ``large`` rows of fixture data.
+
+    ``app`` must use a scratch database. Returns ``(path, status, small_count, large_count, budget)`` tuples.
+    """
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': password})
+    with app.app_context():
+        seed_fixture(0, small)
+        route_id = db.session.query(Route.id).order_by(Route.id).limit(1).scalar()
+    pages = {page.format(route_id=route_id): budget for page, budget in CHECKED_PAGES.items()}
+    before = {path: _count_queries(client, path) for path in pages}
+
+    with app.app_context():
+        seed_fixture(small, large)
+    results = []
+    for path, budget in pages.items():
+        status, count = _count_queries(client, path)
+        results.append((path, max(status, before[path][0]), before[path][1], count, budget))
+    return results
+
+
+def search_results(app):
+    """Run every search case against ``SEARCH_FIXTURE`` in ``app``'s scratch database.
+
+    Province filters are passed with Arabic letters, as some imported files
+    have them. Returns ``(query, expected, found)`` tuples of fixture indexes.
+    """
+    with app.app_context():
+        provinces = [p.name for p in Province.query.order_by(Province.id).limit(2)]
+        fixture_index = {}
+        for i, (name, bname, number, address, province) in enumerate(SEARCH_FIXTURE):
+            customer = CustomerReport(name=name, bname=bname, number=number, textbox29=address,
+                                      province=provinces[province])
+            db.session.add(customer)
+            db.session.flush()
+            fixture_index[customer.id] = i
+        db.session.commit()
+
+        results = []
+        for query, province, expected in SEARCH_CASES:
+            if province is not None:
+                province = provinces[province].replace('ی', 'ي').replace('ک', 'ك')
+            found, total = search_customers(query, province, per_page=len(SEARCH_FIXTURE) + 1)
+            results.append((query, expected, {fixture_index[c.id] for c in found}))
+    return results
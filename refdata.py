@@ -0,0 +1,259 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process deployments only
+    fcntl = None
+
+from extentions import db
+from metrics import cache_lookups
+from models import DescriptiveCriterion, GradeMapping, GradeWeight, Province, ProvinceTarget, QuotaCategory
+
+UNGRADED = 'بدون درجه'
+
+REFERENCE_MODELS = (GradeMapping, Province, ProvinceTarget, DescriptiveCriterion, QuotaCategory, GradeWeight)
+# Process-local caches elsewhere that other workers must drop when one worker changes their data
+SHARED_CACHES = ('map_clusters', 'heatmap', 'geofences', 'identity')
+# One shared version counter per table and per shared cache, in this order
+_SLOTS = {name: slot for slot, name in enumerate(
+    tuple(model.__tablename__ for model in REFERENCE_MODELS) + SHARED_CACHES)}
+
+_VERSIONS_MAGIC = 0x31534E5246455223  # "#REFNS1"
+_MAGIC = struct.Struct('<Q')
+_VERSION = struct.Struct('<Q')
+_FILE_SIZE = _MAGIC.size + _VERSION.size * len(_SLOTS)
+
+
+class ReferenceCache:
+    """Process-local cache of small reference tables, shared-invalidated across workers.
+
+    Each table has a version counter in a memory-mapped file that every
+    worker maps (as do the caches in ``SHARED_CACHES``, see ``SharedVersion``). Committing a change to a table bumps its counter; a cached
+    entry is served only while the counters of the tables it was built from
+    are unchanged, so one worker's commit is seen by every other worker on
+    its next lookup. Entries hold immutable row snapshots, never ORM
+    instances, so they can be shared between requests and threads.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._mm = None
+
+    def init_app(self, app):
+        self.path = app.config.get('REFERENCE_VERSIONS_PATH') or \
+            os.path.join(app.instance_path, 'reference_versions.bin')
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._reset()
+        with self._locked():
+            resized = os.fstat(self._fd).st_size != _FILE_SIZE
+            if resized:
+                os.ftruncate(self._fd, _FILE_SIZE)
+            self._mm = mmap.mmap(self._fd, _FILE_SIZE)
+            if resized or _MAGIC.unpack_from(self._mm, 0)[0] != _VERSIONS_MAGIC:
+                # Start from the clock so a recreated file never repeats a version some worker cached
+                now_ms = int(time.time() * 1000)
+                for slot in range(len(_SLOTS)):
+                    _VERSION.pack_into(self._mm, _MAGIC.size + slot * _VERSION.size, now_ms)
+                _MAGIC.pack_into(self._mm, 0, _VERSIONS_MAGIC)
+        self._entries = {}
+
+    def _reset(self):
+        # Lock files are per open file description, so every process reopens its own
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _versions(self, names):
+        if self._mm is None:
+            return None
+        return tuple(_VERSION.unpack_from(self._mm, _MAGIC.size + _SLOTS[n] * _VERSION.size)[0] for n in names)
+
+    def get(self, key, models, loader):
+        """Return the cached ``loader()`` result for ``key``, rebuilding it if any of ``models`` changed."""
+        tables = tuple(model.__tablename__ for model in models)
+        if db.session().info.get('reference_tables', set()).intersection(tables):
+            # This transaction changed the table; its view must not be cached or be served stale
+            return loader()
+        # Read the versions before loading, so a change committed mid-load invalidates the result
+        versions = self._versions(tables)
+        entry = self._entries.get(key)
+        if entry is not None and versions is not None and entry[0] == versions:
+            cache_lookups.inc(key, 'hit')
+            return entry[1]
+        cache_lookups.inc(key, 'miss')
+        value = loader()
+        if versions is not None:
+            self._entries[key] = (versions, value)
+        return value
+
+    def bump(self, names):
+        """Move the counters of tables or shared caches; returns their new versions, or None."""
+        if self._mm is None:
+            return None
+        versions = []
+        with self._locked():
+            for name in names:
+                offset = _MAGIC.size + _SLOTS[name] * _VERSION.size
+                versions.append(_VERSION.unpack_from(self._mm, offset)[0] + 1)
+                _VERSION.pack_into(self._mm, offset, versions[-1])
+        return versions
+
+
+reference_cache = ReferenceCache()
+
+
+class SharedVersion:
+    """Keeps one process-local cache consistent with the same cache in other workers.
+
+    The owner calls ``publish()`` after it has invalidated its own entries
+    for a commit, and clears everything when ``moved()`` reports that some
+    other worker has published since.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._seen = None
+        self._lock = threading.Lock()
+
+    def moved(self):
+        versions = reference_cache._versions((self.name,))
+        if versions is None:
+            return False
+        with self._lock:
+            moved, self._seen = versions[0] != self._seen, versions[0]
+        return moved
+
+    def publish(self):
+        with self._lock:
+            seen = self._seen
+            versions = reference_cache.bump((self.name,))
+            # Our own change is already applied locally; anyone else's must still clear our cache
+            if versions is not None and seen == versions[0] - 1:
+                self._seen = versions[0]
+
+
+def _snapshot(model, *order_by):
+    return tuple(db.session.query(*model.__table__.columns).order_by(*order_by).all())
+
+
+# --------------------- Cached lookups ---------------------
+def get_grade_mappings():
+    """Grade mappings, highest minimum score first."""
+    return reference_cache.get('grade_mappings', (GradeMapping,),
+                               lambda: _snapshot(GradeMapping, GradeMapping.min_score.desc()))
+
+
+def grade_for_score(score):
+    """Letter of the highest grade whose minimum score ``score`` reaches, or ``UNGRADED``."""
+    for mapping in get_grade_mappings():
+        if mapping.min_score <= score:
+            return mapping.grade_letter
+    return UNGRADED
+
+
+def get_provinces():
+    return reference_cache.get('provinces', (Province,), lambda: _snapshot(Province, Province.name))
+
+
+def get_latest_province_targets():
+    """The newest target of every province that has one, by province id."""
+    def load():
+        latest = {}
+        for target in _snapshot(ProvinceTarget, ProvinceTarget.id.desc()):
+            latest.setdefault(target.province_id, target)
+        return latest
+    return reference_cache.get('latest_province_targets', (ProvinceTarget,), load)
+
+
+def get_descriptive_criteria():
+    return reference_cache.get('descriptive_criteria', (DescriptiveCriterion,),
+                               lambda: _snapshot(DescriptiveCriterion, DescriptiveCriterion.id))
+
+
+def criterion_score(parameter_name, criterion):
+    """Score of a descriptive criterion, matched case-insensitively; None if undefined."""
+    def load():
+        scores = {}
+        for crit in get_descriptive_criteria():
+            scores.setdefault((crit.parameter_name.lower(), crit.criterion.lower()), crit.score)
+        return scores
+    scores = reference_cache.get('criterion_scores', (DescriptiveCriterion,), load)
+    return scores.get((parameter_name.lower(), criterion.lower()))
+
+
+def get_grade_weights():
+    """Saved allocation weight per grade; empty until an admin saves some."""
+    return reference_cache.get('grade_weights', (GradeWeight,),
+                               lambda: {w.grade: w.weight for w in _snapshot(GradeWeight, GradeWeight.id)})
+
+
+def save_grade_weights(weights):
+    """Replace the saved grade weights; the caller commits."""
+    GradeWeight.query.delete()
+    db.session.add_all(GradeWeight(grade=grade, weight=weight) for grade, weight in weights.items())
+
+
+def get_quota_categories():
+    return reference_cache.get('quota_categories', (QuotaCategory,),
+                               lambda: _snapshot(QuotaCategory, QuotaCategory.id))
+
+
+# --------------------- Invalidation ---------------------
+def _changed_tables(session):
+    return session.info.setdefault('reference_tables', set())
+
+
+def _record_change(mapper, connection, target):
+    state = db.inspect(target)
+    if state.session is not None:
+        _changed_tables(state.session).add(mapper.local_table.name)
+
+
+def _record_bulk_change(context):
+    # Query.update()/delete() skip the mapper events
+    if context.mapper.local_table.name in _SLOTS:
+        _changed_tables(context.session).add(context.mapper.local_table.name)
+
+
+for _model in REFERENCE_MODELS:
+    event.listen(_model, 'after_insert', _record_change)
+    event.listen(_model, 'after_update', _record_change)
+    event.listen(_model, 'after_delete', _record_change)
+
+event.listen(Session, 'after_bulk_update', _record_bulk_change)
+event.listen(Session, 'after_bulk_delete', _record_bulk_change)
+
+
+# Bump only once the change is committed; lookups read the version before loading,
+# so a load that raced the commit is cached under the old version and rebuilt
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    tables = session.info.pop('reference_tables', None)
+    if tables:
+        reference_cache.bump(tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('reference_tables', None)
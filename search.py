@@ -0,0 +1,197 @@
+import re
+
+from sqlalchemy import event, func, or_, text
+
+from extentions import db
+from models import CustomerReport
+
+SEARCH_TABLE = 'customer_search'
+
+# Address-like free-text columns folded into one indexed "address" column
+ADDRESS_FIELDS = ('textbox29', 'textbox16', 'textbox12', 'textbox4', 'textbox10')
+INDEXED_FIELDS = ('name', 'bname', 'number') + ADDRESS_FIELDS
+
+# Arabic code points that often arrive in imported files, folded to their Persian
+# forms; Arabic-Indic and Persian digits become ASCII so numbers match either way
+_PERSIAN_TRANSLATION = str.maketrans({
+    'ي': 'ی',
+    'ى': 'ی',
+    'ك': 'ک',
+    '\u0640': '',  # tatweel
+    '\u200c': ' ',  # zero-width non-joiner
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+})
+# The same folding as arguments to SQL translate(), for databases without the index:
+# characters past the end of the replacement string are deleted
+_SQL_FOLD_FROM = ''.join(c for c in map(chr, _PERSIAN_TRANSLATION) if _PERSIAN_TRANSLATION[ord(c)]) + '\u0640'
+_SQL_FOLD_TO = ''.join(_PERSIAN_TRANSLATION[ord(c)] for c in _SQL_FOLD_FROM[:-1])
+
+_TOKEN_RE = re.compile(r'\w+')
+
+REBUILD_BATCH_SIZE = 5000
+
+
+def normalize_persian(value):
+    """Normalize Persian/Arabic variants so indexed text and queries compare equal."""
+    if value is None:
+        return ''
+    return str(value).translate(_PERSIAN_TRANSLATION).strip()
+
+
+def province_token(province):
+    """Collapse a province name into one token so it can be used as an FTS5 column filter."""
+    return ''.join(_TOKEN_RE.findall(normalize_persian(province)))
+
+
+def _is_supported(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def _index_row(customer):
+    return {
+        'rowid': customer.id,
+        'name': normalize_persian(customer.name),
+        'bname': normalize_persian(customer.bname),
+        'number': normalize_persian(customer.number),
+        'address': ' '.join(normalize_persian(getattr(customer, f)) for f in ADDRESS_FIELDS if getattr(customer, f)),
+        'province': province_token(customer.province),
+    }
+
+
+_INSERT_SQL = text(
+    f"INSERT INTO {SEARCH_TABLE} (rowid, name, bname, number, address, province) "
+    "VALUES (:rowid, :name, :bname, :number, :address, :province)"
+)
+_DELETE_SQL = text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid")
+
+
+def ensure_search_index():
+    """Create the FTS5 table and backfill it if customers exist but are not indexed yet."""
+    if not _is_supported(db.engine):
+        return
+    db.session.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "name, bname, number, address, province, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+    # Name hits weigh most, then customer number, then shop name, then address
+    db.session.execute(text(
+        f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rank) "
+        "VALUES ('rank', 'bm25(10.0, 5.0, 8.0, 1.0, 0.0)')"
+    ))
+    indexed = db.session.execute(text(f"SELECT COUNT(*) FROM {SEARCH_TABLE}")).scalar()
+    if not indexed and db.session.query(CustomerReport.id).first():
+        rebuild_search_index()
+    db.session.commit()
+
+
+def rebuild_search_index():
+    """Drop and re-populate every index entry from customer_report."""
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    columns = [getattr(CustomerReport, f) for f in ('id', 'province') + INDEXED_FIELDS]
+    query = db.session.query(*columns).execution_options(yield_per=REBUILD_BATCH_SIZE)
+    batch = []
+    for row in query:
+        batch.append(_index_row(row))
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            db.session.execute(_INSERT_SQL, batch)
+            batch = []
+    if batch:
+        db.session.execute(_INSERT_SQL, batch)
+
+
+def remove_province_from_index(province):
+    """Drop index entries for a province (bulk deletes bypass the mapper events)."""
+    if not _is_supported(db.engine):
+        return
+    db.session.execute(text(
+        f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN "
+        f"(SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match)"
+    ), {'match': f'province : "{province_token(province)}"'})
+
+
+def build_match_query(query, province=None):
+    """Turn free user input into an FTS5 prefix query; every term must match."""
+    tokens = _TOKEN_RE.findall(normalize_persian(query))
+    if not tokens:
+        return ''
+    match = '{name bname number address} : (' + ' '.join(f'"{token}"*' for token in tokens) + ')'
+    if province:
+        # Exact (non-prefix) token match, resolved inside the index instead of a post-filter
+        match += f' AND province : "{province_token(province)}"'
+    return match
+
+
+def search_customers(query, province=None, page=1, per_page=20):
+    """Return (customers, total) ranked by bm25, best match first; by name without FTS5."""
+    match = build_match_query(query, province)
+    if not match:
+        return [], 0
+    if not _is_supported(db.session.connection()):
+        return _search_without_index(query, province, page, per_page)
+
+    total = db.session.execute(
+        text(f"SELECT COUNT(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match"),
+        {'match': match}
+    ).scalar()
+
+    rows = db.session.execute(text(
+        f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match "
+        "ORDER BY rank LIMIT :limit OFFSET :offset"
+    ), {'match': match, 'limit': per_page, 'offset': (page - 1) * per_page}).fetchall()
+
+    ids = [row[0] for row in rows]
+    if not ids:
+        return [], total
+    by_id = {c.id: c for c in CustomerReport.query.filter(CustomerReport.id.in_(ids))}
+    return [by_id[i] for i in ids if i in by_id], total
+
+
+def _folded(column):
+    return func.translate(column, _SQL_FOLD_FROM, _SQL_FOLD_TO)
+
+
+def _search_without_index(query, province, page, per_page):
+    """Substring search for databases without FTS5; every term must match, ordered by name.
+
+    Searches the same columns as the index, with stored text folded like
+    ``normalize_persian`` in SQL, so Arabic and Persian spellings match
+    either way; only the ranking differs.
+    """
+    columns = [_folded(getattr(CustomerReport, field)) for field in INDEXED_FIELDS]
+    filters = []
+    for token in _TOKEN_RE.findall(normalize_persian(query)):
+        # Tokens are \w+, so an underscore is the only LIKE wildcard they can contain
+        pattern = '%' + token.replace('_', '\\_') + '%'
+        filters.append(or_(*(column.ilike(pattern, escape='\\') for column in columns)))
+    if province:
+        filters.append(_folded(CustomerReport.province) == normalize_persian(province))
+    found = CustomerReport.query.filter(*filters).order_by(CustomerReport.name, CustomerReport.id) \
+        .paginate(page=page, per_page=per_page, error_out=False)
+    return found.items, found.total
+
+
+# --------------------- Keep the index in sync with the ORM ---------------------
+@event.listens_for(CustomerReport, 'after_insert')
+def _index_inserted_customer(mapper, connection, target):
+    if _is_supported(connection):
+        connection.execute(_INSERT_SQL, _index_row(target))
+
+
+@event.listens_for(CustomerReport, 'after_update')
+def _reindex_updated_customer(mapper, connection, target):
+    if not _is_supported(connection):
+        return
+    # Grade changes from evaluations are frequent and do not touch indexed text
+    state = db.inspect(target)
+    if not any(state.attrs[f].history.has_changes() for f in INDEXED_FIELDS + ('province',)):
+        return
+    connection.execute(_DELETE_SQL, {'rowid': target.id})
+    connection.execute(_INSERT_SQL, _index_row(target))
+
+
+@event.listens_for(CustomerReport, 'after_delete')
+def _unindex_deleted_customer(mapper, connection, target):
+    if _is_supported(connection):
+        connection.execute(_DELETE_SQL, {'rowid': target.id})
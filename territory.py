@@ -0,0 +1,229 @@
+import time
+
+import numpy as np
+from sqlalchemy import insert
+
+from extentions import db
+from geo import project_m
+from refdata import UNGRADED, get_grade_mappings
+from models import CustomerReport, Route, RouteAssignment, RoutePoint
+
+UNGRADED_WEIGHT = 0.5
+
+# Center updates per balanced two-way split; they usually settle in three or four
+SPLIT_ITERATIONS = 10
+# Refinement re-splits each territory with this many of its nearest neighbors per pass
+REFINE_NEIGHBORS = 4
+REFINE_PASSES = 10
+# Refinement stops once a pass shrinks the total spread by less than this fraction
+REFINE_MIN_GAIN = 0.001
+# Territories up to this size are sequenced by nearest neighbor, larger ones by a serpentine sweep
+GREEDY_SEQUENCE_LIMIT = 5000
+
+
+def default_grade_weights():
+    """Relative weight per grade: its minimum score / 100, as on the province targets page."""
+    weights = {g.grade_letter: g.min_score / 100 for g in get_grade_mappings()}
+    weights[UNGRADED] = UNGRADED_WEIGHT
+    return weights
+
+
+def _spread(points, weights):
+    """Weighted sum of squared distances to the weighted center."""
+    center = np.average(points, axis=0, weights=weights)
+    return float((weights * ((points - center) ** 2).sum(axis=1)).sum())
+
+
+def _balanced_split(points, weights, fraction, centers=None, min_sizes=(1, 1)):
+    """Two-way capacity-constrained k-means.
+
+    With two centers fixed, the cheapest split that puts ``fraction`` of the
+    weight on the first side is found by sorting points on the difference of
+    their squared distances to the centers and cutting at the weighted
+    quantile. The centers then move to their sides' weighted means and the
+    split repeats. Without ``centers``, the first cut is across the principal
+    axis. Returns the first side's mask and both centers.
+    """
+    if centers is None:
+        mean = np.average(points, axis=0, weights=weights)
+        axis = np.linalg.eigh(np.cov((points - mean).T, aweights=weights))[1][:, -1]
+        key = (points - mean) @ axis
+    first = None
+    for _ in range(SPLIT_ITERATIONS):
+        if centers is not None:
+            key = ((points - centers[0]) ** 2).sum(axis=1) - ((points - centers[1]) ** 2).sum(axis=1)
+        order = np.argsort(key)
+        cut = int(np.searchsorted(np.cumsum(weights[order]), fraction * weights.sum())) + 1
+        cut = min(max(cut, min_sizes[0]), len(points) - min_sizes[1])
+        mask = np.zeros(len(points), dtype=bool)
+        mask[order[:cut]] = True
+        if first is not None and np.array_equal(mask, first):
+            break
+        first = mask
+        centers = (np.average(points[first], axis=0, weights=weights[first]),
+                   np.average(points[~first], axis=0, weights=weights[~first]))
+    return first, centers
+
+
+def _bisect(points, weights, k):
+    """Recursive balanced bisection into ``k`` groups, each side sized by its share of ``k``."""
+    labels = np.empty(len(points), dtype=np.int64)
+    stack = [(np.arange(len(points)), k, 0)]
+    while stack:
+        members, groups, first_label = stack.pop()
+        if groups == 1:
+            labels[members] = first_label
+            continue
+        left = groups // 2
+        mask, _ = _balanced_split(points[members], weights[members], left / groups,
+                                  min_sizes=(left, groups - left))
+        stack.append((members[mask], left, first_label))
+        stack.append((members[~mask], groups - left, first_label + left))
+    return labels
+
+
+def _refine(points, weights, labels, k):
+    """Re-split neighboring territory pairs while that makes them more compact.
+
+    Each pair keeps its combined weight and is split evenly again, so the
+    balance from bisection is preserved while the boundaries bisection drew
+    early on are straightened out. Returns the labels and passes run.
+    """
+    members = [np.flatnonzero(labels == group) for group in range(k)]
+    centers = np.array([np.average(points[m], axis=0, weights=weights[m]) for m in members])
+    spreads = np.array([_spread(points[m], weights[m]) for m in members])
+    passes = 0
+    for passes in range(1, REFINE_PASSES + 1):
+        distances = ((centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(distances, np.inf)
+        nearest = np.argsort(distances, axis=1)[:, :REFINE_NEIGHBORS]
+        pairs = sorted({(min(a, b), max(a, b)) for a in range(k) for b in nearest[a]})
+        before = spreads.sum()
+        for a, b in pairs:
+            union = np.concatenate([members[a], members[b]])
+            mask, pair_centers = _balanced_split(points[union], weights[union], 0.5,
+                                                 centers=(centers[a], centers[b]))
+            first, second = union[mask], union[~mask]
+            spread_a, spread_b = _spread(points[first], weights[first]), _spread(points[second], weights[second])
+            if spread_a + spread_b < spreads[a] + spreads[b]:
+                members[a], members[b] = first, second
+                centers[a], centers[b] = pair_centers
+                spreads[a], spreads[b] = spread_a, spread_b
+        if before - spreads.sum() <= REFINE_MIN_GAIN * before:
+            break
+
+    for group, m in enumerate(members):
+        labels[m] = group
+    return labels, passes
+
+
+def partition(lat, lng, weights, k):
+    """Split weighted points into ``k`` compact groups of near-equal total weight.
+
+    Capacity-constrained k-means by recursive balanced bisection, then
+    pairwise refinement of neighboring groups. Every split divides the
+    weight exactly, so loads come out equal to within a customer or two;
+    100k customers take a few seconds.
+
+    Returns ``(labels, stats)``.
+    """
+    started = time.perf_counter()
+    points = np.column_stack(project_m(np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64)))
+    weights = np.asarray(weights, dtype=np.float64)
+    k = min(k, len(points))
+    labels = _bisect(points, weights, k)
+    passes = 0
+    if k > 1:
+        labels, passes = _refine(points, weights, labels, k)
+
+    target = weights.sum() / k
+    loads = np.bincount(labels, weights=weights, minlength=k)
+    spread = sum(_spread(points[labels == group], weights[labels == group]) for group in range(k))
+    return labels, {
+        'groups': int(k),
+        'refine_passes': passes,
+        'min_load_ratio': round(float(loads.min() / target), 3),
+        'max_load_ratio': round(float(loads.max() / target), 3),
+        # Weighted root-mean-square distance of customers from their territory's center
+        'rms_radius_km': round(float(np.sqrt(spread / weights.sum())) / 1000, 2),
+        'seconds': round(time.perf_counter() - started, 2),
+    }
+
+
+def _sequence(points):
+    """Visiting order for one territory, starting at the stop farthest from its center.
+
+    Greedy nearest neighbor for ordinary territories; very large ones get a
+    serpentine sweep over horizontal strips instead. Either way, the route
+    page's optimize action can improve the order afterwards.
+    """
+    n = len(points)
+    if n > GREEDY_SEQUENCE_LIMIT:
+        strips = int(np.ceil(np.sqrt(n / 2)))
+        strip = np.minimum((np.argsort(np.argsort(points[:, 1])) * strips) // n, strips - 1)
+        along = np.where(strip % 2 == 0, points[:, 0], -points[:, 0])
+        return np.lexsort((along, strip))
+
+    remaining = np.ones(n, dtype=bool)
+    current = int(np.argmax(((points - points.mean(axis=0)) ** 2).sum(axis=1)))
+    order = np.empty(n, dtype=np.int64)
+    for position in range(n):
+        order[position] = current
+        remaining[current] = False
+        if position == n - 1:
+            break
+        distances = ((points - points[current]) ** 2).sum(axis=1)
+        distances[~remaining] = np.inf
+        current = int(np.argmin(distances))
+    return order
+
+
+def create_territory_routes(province, k, grade_weights, marketer_ids=()):
+    """Partition a province's geocoded customers into ``k`` routes and store them.
+
+    Customers are weighted by grade (visit frequency), so every route carries
+    about the same workload. When ``marketer_ids`` are given, the i-th
+    marketer is assigned the i-th route. The caller commits.
+    Returns ``(routes, stats)``.
+    """
+    customers = db.session.query(
+        CustomerReport.name, CustomerReport.number, CustomerReport.latitude, CustomerReport.longitude,
+        CustomerReport.grade
+    ).filter(CustomerReport.province == province, CustomerReport.latitude.isnot(None),
+             CustomerReport.longitude.isnot(None)).all()
+    if not customers:
+        return [], {'groups': 0, 'customers': 0}
+
+    lat = np.fromiter((c.latitude for c in customers), np.float64, len(customers))
+    lng = np.fromiter((c.longitude for c in customers), np.float64, len(customers))
+    weights = np.fromiter((grade_weights.get(c.grade or UNGRADED, UNGRADED_WEIGHT) for c in customers),
+                          np.float64, len(customers))
+    # A zero weight would let a customer land anywhere without counting; keep every customer counted
+    weights = np.maximum(weights, 1e-3)
+    labels, stats = partition(lat, lng, weights, k)
+    points = np.column_stack(project_m(lat, lng))
+
+    routes = [Route(name=f'{province} - مسیر {i + 1}', province=province,
+                    description='ایجاد خودکار از تقسیم‌بندی مشتریان استان') for i in range(stats['groups'])]
+    db.session.add_all(routes)
+    db.session.flush()
+
+    rows = []
+    for group, route in enumerate(routes):
+        members = np.flatnonzero(labels == group)
+        for position, index in enumerate(members[_sequence(points[members])], start=1):
+            customer = customers[index]
+            rows.append({
+                'route_id': route.id,
+                'latitude': customer.latitude,
+                'longitude': customer.longitude,
+                'name': (customer.name or '')[:100] or None,
+                # RoutePoint has no customer link; the customer code lets a marketer find the record
+                'address': f'کد مشتری {customer.number}' if customer.number else None,
+                'order': position,
+            })
+    db.session.execute(insert(RoutePoint), rows)
+
+    for route, marketer_id in zip(routes, marketer_ids):
+        db.session.add(RouteAssignment(route_id=route.id, marketer_id=marketer_id))
+    return routes, {**stats, 'customers': len(customers)}
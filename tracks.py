@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import func
+
+from extentions import db
+from geo import simplify_mask
+from locations import BATCH_MAX_AGE, BATCH_MAX_CLOCK_SKEW
+from models import LocationPing
+
+DELETE_BATCH_SIZE = 500
+
+
+def ping_time():
+    """When a ping was taken: the device clock if it sent one, else its arrival."""
+    return func.coalesce(LocationPing.device_time, LocationPing.server_time)
+
+
+def day_track(marketer_id, day, tolerance_m):
+    """One UTC day of a marketer's history, simplified; returns ``(points, raw_count)``."""
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    end = start + timedelta(days=1)
+    taken = ping_time().label('taken')
+    rows = db.session.query(LocationPing.lat, LocationPing.lng, taken).filter(
+        LocationPing.marketer_id == marketer_id,
+        # Uploads are only accepted within this window, which lets the index narrow the scan
+        LocationPing.server_time >= start - BATCH_MAX_CLOCK_SKEW,
+        LocationPing.server_time < end + BATCH_MAX_AGE,
+        taken >= start, taken < end
+    ).order_by(taken).all()
+    if not rows:
+        return [], 0
+
+    lat = np.fromiter((r[0] for r in rows), np.float64, len(rows))
+    lng = np.fromiter((r[1] for r in rows), np.float64, len(rows))
+    kept = np.flatnonzero(simplify_mask(lat, lng, tolerance_m))
+    return [[rows[i][0], rows[i][1], rows[i][2].strftime('%H:%M:%S')] for i in kept], len(rows)
+
+
+def compress_history(before, tolerance_m):
+    """Delete stored pings taken before ``before`` that simplification drops, day by day.
+
+    Returns ``(examined, deleted)``.
+    """
+    # An offline job, so scanning by when pings were taken (not when they arrived) is fine
+    marketer_ids = [m for (m,) in db.session.query(LocationPing.marketer_id)
+                    .filter(ping_time() < before).distinct()]
+    examined = deleted = 0
+    for marketer_id in marketer_ids:
+        taken = ping_time().label('taken')
+        query = db.session.query(LocationPing.id, LocationPing.lat, LocationPing.lng, taken).filter(
+            LocationPing.marketer_id == marketer_id, taken < before
+        ).order_by(taken).execution_options(yield_per=10000)
+
+        drop = []
+        day, ids, lats, lngs = None, [], [], []
+        for row_id, lat, lng, when in query:
+            if when.date() != day:
+                drop.extend(_dropped(ids, lats, lngs, tolerance_m))
+                day, ids, lats, lngs = when.date(), [], [], []
+            ids.append(row_id)
+            lats.append(lat)
+            lngs.append(lng)
+            examined += 1
+        drop.extend(_dropped(ids, lats, lngs, tolerance_m))
+
+        for i in range(0, len(drop), DELETE_BATCH_SIZE):
+            db.session.query(LocationPing).filter(LocationPing.id.in_(drop[i:i + DELETE_BATCH_SIZE])) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(drop)
+    return examined, deleted
+
+
+def _dropped(ids, lats, lngs, tolerance_m):
+    if len(ids) < 3:
+        return []
+    keep = simplify_mask(np.array(lats), np.array(lngs), tolerance_m)
+    return [ids[i] for i in np.flatnonzero(~keep)]
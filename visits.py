@@ -0,0 +1,268 @@
+import threading
+import time
+from datetime import timezone
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from extentions import db
+from geo import METERS_PER_DEGREE_LAT, haversine_m
+from metrics import cache_lookups
+from models import Route, RouteAssignment, RoutePoint, RouteProgress, VisitEvent
+from refdata import SharedVersion
+
+
+class RouteGeofence:
+    """The points of one route sorted by latitude, for O(log n) radius lookups."""
+
+    def __init__(self, points):
+        import numpy as np
+        points = sorted(points, key=lambda p: p[1])
+        self.ids = np.array([p[0] for p in points], dtype=np.int64)
+        self.lat = np.array([p[1] for p in points], dtype=np.float64)
+        self.lng = np.array([p[2] for p in points], dtype=np.float64)
+        # Planned visiting order per point id
+        self.orders = {p[0]: p[3] for p in points}
+
+    def within(self, lat, lng, radius_m):
+        """Yield ``(point_id, distance_m)`` for route points within ``radius_m``."""
+        import numpy as np
+        dlat = radius_m / METERS_PER_DEGREE_LAT
+        lo, hi = np.searchsorted(self.lat, (lat - dlat, lat + dlat))
+        if lo == hi:
+            return
+        distances = haversine_m(lat, lng, self.lat[lo:hi], self.lng[lo:hi])
+        for i in np.flatnonzero(distances <= radius_m):
+            yield int(self.ids[lo + i]), float(distances[i])
+
+
+class VisitDetector:
+    """Turns stored location pings into visit events at the marketer's route points.
+
+    Every ping is checked against the geofences of the marketer's active route
+    assignments. A visit opens when the marketer comes within
+    ``VISIT_ENTER_RADIUS_METERS`` of a point and closes, with its dwell time,
+    at the first ping beyond ``VISIT_EXIT_RADIUS_METERS``; the wider exit
+    radius keeps GPS jitter at the edge from splitting one visit into many.
+    Open visits live in the database, so pings handled by any worker continue
+    the same visit.
+
+    Each assignment's ``RouteProgress`` starts at its first visit and is then
+    advanced in place: distinct points visited, visits that came after a
+    later point in the planned order, distance between consecutive pings and
+    time on the route. The assignment is marked completed once every point
+    has been visited.
+
+    Assignments and geofences are cached per process, dropped when routes or
+    assignments are committed here and otherwise after ``GEOFENCE_CACHE_SECONDS``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assignments = {}
+        self._fences = {}
+        self._loaded_at = time.monotonic()
+        self._shared = SharedVersion('geofences')
+
+    def init_app(self, app):
+        self.enter_radius = app.config.get('VISIT_ENTER_RADIUS_METERS', 50)
+        self.exit_radius = max(app.config.get('VISIT_EXIT_RADIUS_METERS', 80), self.enter_radius)
+        self.cache_seconds = app.config.get('GEOFENCE_CACHE_SECONDS', 60)
+
+    def invalidate(self):
+        with self._lock:
+            self._assignments = {}
+            self._fences = {}
+            self._loaded_at = time.monotonic()
+        self._shared.publish()
+
+    def _routes_for(self, marketer_ids):
+        """Active ``(assignment_id, route_id, fence)`` triples per marketer id."""
+        with self._lock:
+            if self._shared.moved() or time.monotonic() - self._loaded_at > self.cache_seconds:
+                self._assignments, self._fences = {}, {}
+                self._loaded_at = time.monotonic()
+
+            missing = [m for m in marketer_ids if m not in self._assignments]
+            cache_lookups.inc('geofences', 'hit', amount=len(marketer_ids) - len(missing))
+            cache_lookups.inc('geofences', 'miss', amount=len(missing))
+            if missing:
+                found = {m: [] for m in missing}
+                assignments = db.session.query(
+                    RouteAssignment.id, RouteAssignment.marketer_id, RouteAssignment.route_id
+                ).join(Route, Route.id == RouteAssignment.route_id).filter(
+                    RouteAssignment.marketer_id.in_(missing),
+                    RouteAssignment.is_active.is_(True),
+                    db.or_(RouteAssignment.completed.is_(False), RouteAssignment.completed.is_(None)),
+                    Route.is_active.is_(True)
+                )
+                for assignment_id, marketer_id, route_id in assignments:
+                    found[marketer_id].append((assignment_id, route_id))
+                self._assignments.update(found)
+
+            route_ids = {r for m in marketer_ids for _, r in self._assignments[m] if r not in self._fences}
+            if route_ids:
+                points = {r: [] for r in route_ids}
+                rows = db.session.query(RoutePoint.id, RoutePoint.route_id, RoutePoint.latitude,
+                                        RoutePoint.longitude, RoutePoint.order).filter(RoutePoint.route_id.in_(route_ids))
+                for point_id, route_id, lat, lng, order in rows:
+                    points[route_id].append((point_id, lat, lng, order))
+                self._fences.update({r: RouteGeofence(p) for r, p in points.items()})
+
+            return {m: [(a, r, self._fences[r]) for a, r in self._assignments[m]] for m in marketer_ids}
+
+    def record(self, pings):
+        """Open and close visits and advance route progress for stored ping dicts.
+
+        Runs in the caller's transaction.
+        """
+        by_marketer = {}
+        for ping in pings:
+            by_marketer.setdefault(ping['marketer_id'], []).append(ping)
+        routes = self._routes_for(list(by_marketer))
+        by_marketer = {m: p for m, p in by_marketer.items() if routes[m]}
+        if not by_marketer:
+            return
+
+        open_visits = {}
+        for visit in VisitEvent.query.filter(VisitEvent.marketer_id.in_(by_marketer),
+                                             VisitEvent.exited_at.is_(None)):
+            open_visits.setdefault(visit.marketer_id, {})[(visit.assignment_id, visit.route_point_id)] = visit
+
+        assignment_ids = [a for m in by_marketer for a, _, _ in routes[m]]
+        progress = {p.assignment_id: p for p in
+                    RouteProgress.query.filter(RouteProgress.assignment_id.in_(assignment_ids))}
+        visited = {a: set() for a in assignment_ids}
+        for assignment_id, point_id in db.session.query(VisitEvent.assignment_id, VisitEvent.route_point_id) \
+                .filter(VisitEvent.assignment_id.in_(assignment_ids)).distinct():
+            visited[assignment_id].add(point_id)
+
+        for marketer_id, marketer_pings in by_marketer.items():
+            visits = open_visits.get(marketer_id, {})
+            marketer_pings.sort(key=_taken_at)
+            for ping in marketer_pings:
+                self._step(marketer_id, routes[marketer_id], visits, progress, visited, ping)
+
+    def _step(self, marketer_id, active, visits, progress, visited, ping):
+        when = _taken_at(ping)
+        lat, lng = ping['lat'], ping['lng']
+        for assignment_id, _, _ in active:
+            _advance(progress.get(assignment_id), lat, lng, when)
+
+        inside = set()
+        for assignment_id, route_id, fence in active:
+            for point_id, distance in fence.within(lat, lng, self.exit_radius):
+                key = (assignment_id, point_id)
+                if distance > self.enter_radius and key not in visits:
+                    continue
+                inside.add(key)
+                visit = visits.get(key)
+                if visit is not None:
+                    if when > _utc(visit.last_seen_at):
+                        visit.last_seen_at = when
+                    continue
+
+                visits[key] = VisitEvent(marketer_id=marketer_id, assignment_id=assignment_id,
+                                         route_id=route_id, route_point_id=point_id,
+                                         entered_at=when, last_seen_at=when)
+                db.session.add(visits[key])
+                if point_id not in visited[assignment_id]:
+                    visited[assignment_id].add(point_id)
+                    self._first_visit(assignment_id, route_id, fence, point_id, progress, visited, lat, lng, when)
+
+        for key in [k for k in visits if k not in inside]:
+            visit = visits[key]
+            # A late upload from before the visit must not close it
+            if when <= _utc(visit.last_seen_at):
+                continue
+            visit.exited_at = when
+            visit.dwell_seconds = (when - _utc(visit.entered_at)).total_seconds()
+            del visits[key]
+
+    def _first_visit(self, assignment_id, route_id, fence, point_id, progress, visited, lat, lng, when):
+        """Count a newly visited point and complete the assignment with its last one."""
+        entry = progress.get(assignment_id)
+        if entry is None:
+            entry = progress[assignment_id] = RouteProgress(
+                assignment_id=assignment_id, points_visited=0, out_of_order_visits=0, distance_m=0.0,
+                started_at=when, last_ping_at=when, last_lat=lat, last_lng=lng
+            )
+            db.session.add(entry)
+        order = fence.orders[point_id]
+        if entry.max_order_visited is not None and order < entry.max_order_visited:
+            entry.out_of_order_visits += 1
+        entry.max_order_visited = order if entry.max_order_visited is None else max(entry.max_order_visited, order)
+        entry.points_visited += 1
+        # The cached fence rules out the common case without a query; the database has the final say
+        if fence.orders.keys() <= visited[assignment_id]:
+            complete_finished_assignments(route_id, when, assignment_ids=[assignment_id])
+
+
+def complete_finished_assignments(route_id, when, assignment_ids=None):
+    """Mark the route's started assignments completed once every current point has a visit.
+
+    Called on a first visit and whenever the route's points change, since
+    deleting the last unvisited point finishes a route as well. Runs in the
+    caller's transaction; returns how many assignments were completed.
+    """
+    unvisited = db.select(RoutePoint.id).where(
+        RoutePoint.route_id == route_id,
+        ~db.select(VisitEvent.id).where(VisitEvent.assignment_id == RouteAssignment.id,
+                                        VisitEvent.route_point_id == RoutePoint.id).exists()
+    )
+    query = RouteAssignment.query.filter(
+        RouteAssignment.route_id == route_id,
+        db.or_(RouteAssignment.completed.is_(False), RouteAssignment.completed.is_(None)),
+        db.select(RouteProgress.assignment_id).where(RouteProgress.assignment_id == RouteAssignment.id).exists(),
+        ~unvisited.exists()
+    )
+    if assignment_ids is not None:
+        query = query.filter(RouteAssignment.id.in_(assignment_ids))
+    completed = query.update({'completed': True, 'completed_at': when}, synchronize_session=False)
+    if completed:
+        # The bulk update bypasses the mapper events; completed routes leave the cache on commit
+        db.session().info['geofences_changed'] = True
+    return completed
+
+
+def _advance(entry, lat, lng, when):
+    """Add the leg from the previous ping to a started assignment's distance and time."""
+    if entry is None or when <= _utc(entry.last_ping_at):
+        return
+    entry.distance_m += float(haversine_m(entry.last_lat, entry.last_lng, lat, lng))
+    entry.last_lat, entry.last_lng, entry.last_ping_at = lat, lng, when
+
+
+def _taken_at(ping):
+    return _utc(ping['device_time'] or ping['server_time'])
+
+
+def _utc(value):
+    # SQLite hands DateTime values back naive; they were written as UTC
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+visit_detector = VisitDetector()
+
+
+def _record_change(mapper, connection, target):
+    state = db.inspect(target)
+    if state.session is not None:
+        state.session.info['geofences_changed'] = True
+
+
+for _model in (Route, RoutePoint, RouteAssignment):
+    event.listen(_model, 'after_insert', _record_change)
+    event.listen(_model, 'after_update', _record_change)
+    event.listen(_model, 'after_delete', _record_change)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    if session.info.pop('geofences_changed', None):
+        visit_detector.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('geofences_changed', None)
@@ -0,0 +1,30 @@
+"""Production entry point: ``gunicorn -c gunicorn.conf.py wsgi:app``.
+
+Run ``flask --app app bootstrap`` once per database (and after upgrades)
+before starting the server.
+"""
+from app import create_app
+from extentions import db
+from refdata import get_grade_mappings, get_grade_weights, get_latest_province_targets, get_provinces
+
+app = create_app()
+
+
+def preload():
+    """Load read-only reference data, so workers forked afterwards start with it in memory.
+
+    Lookups still check the shared version counters, so a worker forked
+    from a master holding old data rebuilds it on first use.
+    """
+    with app.app_context():
+        get_provinces()
+        get_grade_mappings()
+        get_grade_weights()
+        get_latest_province_targets()
+        db.session.remove()
+        # Connections must not be shared with forked workers
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+preload()